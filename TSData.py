@@ -2,8 +2,27 @@ import numpy as np     #numpy是提供矩阵运算的库
 import pandas as pd    #基于numpy，内含dataframe和series两种数据
 import json            #json是一种轻量级的数据交换格式，易于人阅读和编写
 import os              #os模块包含普遍的操作系统功能
-from io import StringIO   #io模块是用来处理各种类型的I/O操作流
+from io import StringIO, BytesIO   #io模块是用来处理各种类型的I/O操作流
 import collections        #collections提供了许多有用的集合类
+import gzip
+import warnings
+import tempfile
+import shutil
+import multiprocessing
+import hashlib
+import time
+import contextlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma  # python2: pip install backports.lzma
+    except ImportError:
+        lzma = None
+try:
+    import scipy.sparse as sparse     # optional: sparse gene-set indicator in GetProfiles()
+except ImportError:
+    sparse = None
 
 ##
 # description about TSData format
@@ -20,6 +39,21 @@ import collections        #collections提供了许多有用的集合类
 # 4. meta / event data should be in 'series' metadata.               元/事件 数据需在‘series’元数据里
 # 5. replication event - just need to be in same 'time'.             republication事件需‘时间’相同
 #
+# table of contents: ###TSDataTOC section right after the signature line
+# gives byte offset / length of each section (older files without it are scanned).
+# ###TSDataRowIndex section gives byte offset / length of each ###TSDataMatrix row,
+# so only requested genes can be read from the matrix.
+#
+# delta sections: ###TSDataDeltaHeader / ###TSDataDeltaMatrix pairs appended to the end
+# of the file by save_append(), holding newly added samples. merged at load time,
+# and folded into main sections by compact().
+#
+# compressed file (.tsd.gz / .tsd.xz) is read/written as stream, section by section
+# (no TOC / row index, as compressed stream cannot be seeked efficiently)
+#
+# binary storage mode: ###TSDataMatrix section is replaced with ###TSDataBinary,
+# which refers to a sidecar file (<path>.bin) that holds the matrix as a raw array.
+#
 
 ##
 # general utility    一般效用
@@ -52,7 +86,7 @@ def GetRepFromString(s):
     raise Exception("Cannot extract replication from string: %s" % s)    #raise引发exception异常
 
 def convertTime2Int(l):
-    return [GetTSFromString(e) for e in l]    #将时间数据的格式转换成int形式
+    return ParseTimeArray(l).tolist()         #将时间数据的格式转换成int形式
 
 def convertTime2Str(i):
     # per hour
@@ -67,33 +101,185 @@ def convertTime2Str(i):
         r.append(str(int(i*60))+'m')     #输入的数据在0-1之间则乘60(?)+m
     return ' '.join(r)                   #将空格和r字符串相连
 
+# memo of parsed time strings (string -> hours)
+_time_hours_memo = {}
+
+# @description: Get time data in hours, for array of time values
+# each distinct value is parsed once (and memoized), then broadcast back.
+# missing value (None/NaN) is NaN.
+# @argument errors: 'raise' (raise Exception if unrecognized) / 'coerce' (NaN)
+# returns: float array
+def ParseTimeArray(values, errors='raise'):
+    codes, uniq = pd.factorize(np.asarray(values, dtype=object))
+    hours = np.empty(len(uniq) + 1)
+    hours[-1] = np.nan      # code -1: missing value
+    for i,t in enumerate(uniq):
+        if (isinstance(t, (int, long, float, np.number))):
+            hours[i] = float(t)
+            continue
+        if (t not in _time_hours_memo):
+            try:
+                h = GetTSFromString(t)
+            except (ValueError, IndexError):
+                h = None
+            if (len(_time_hours_memo) > 100000):
+                _time_hours_memo.clear()
+            _time_hours_memo[t] = h
+        h = _time_hours_memo[t]
+        if (h is None):
+            if (errors == 'raise'):
+                raise Exception("Cannot extract time info from string: %s" % t)
+            h = np.nan
+        hours[i] = h
+    return hours[codes]
+
+# @description: group samples by (SeriesID, Time) into integer codes
+# groups are ordered by time (in hours), SeriesID and time string.
+# (unrecognized time string is ordered last)
+# (if sort is False, groups are ordered by first appearance, without parsing time)
+# samples with missing SeriesID or Time are not grouped (code -1).
+# @argument hours: time of each sample in hours, if already parsed (ParseTimeArray())
+# returns: (codes: group number of each sample, keys: [(SeriesID, Time)] of groups)
+def GroupSeries(series_ids, times, sort=True, hours=None):
+    sid_codes, sid_uniq = pd.factorize(np.asarray(series_ids, dtype=object))
+    t_codes, t_uniq = pd.factorize(np.asarray(times, dtype=object))
+    codes = np.full(len(sid_codes), -1, dtype=np.int64)
+    valid = (sid_codes >= 0) & (t_codes >= 0)
+    if (not valid.any()):
+        return (codes, [])
+    pair_codes, pairs = pd.factorize(sid_codes[valid] * len(t_uniq) + t_codes[valid])
+    pair_sid = pairs // len(t_uniq)
+    pair_t = pairs % len(t_uniq)
+    if (not sort):
+        codes[valid] = pair_codes
+        return (codes, zip(sid_uniq[pair_sid], t_uniq[pair_t]))
+    # order groups (timepoint is compared numerically)
+    if (hours is None):
+        t_hours = ParseTimeArray(t_uniq, errors='coerce')
+    else:
+        t_hours = np.empty(len(t_uniq))
+        t_hours[t_codes[valid]] = np.asarray(hours, dtype=float)[valid]
+    order = np.lexsort((
+        np.array([str(t) for t in t_uniq])[pair_t],
+        np.array([str(x) for x in sid_uniq])[pair_sid],
+        t_hours[pair_t]))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    codes[valid] = rank[pair_codes]
+    keys = [(sid_uniq[pair_sid[i]], t_uniq[pair_t[i]]) for i in order]
+    return (codes, keys)
+
+# @description: normalize genenames for lookup
+# (case-folded, and '_' suffix is removed as GeneMatrix.set_refine_index())
+# returns: array of normalized names
+def NormalizeGeneNames(names):
+    names = pd.Series(np.asarray(names, dtype=object)).astype(unicode)
+    return names.str.strip().str.split('_', n=1).str[0].str.upper().values
+
+# @description process pool with temporary directory in memory(tmpfs) if available,
+# where matrices are passed to / from workers as binary files.
+# pool is joined at normal exit and terminated on error, then directory is removed.
+# usage: with WorkerPool(workers, 'prefix') as (pool, tmp_dir): ...
+@contextlib.contextmanager
+def WorkerPool(workers, prefix):
+    tmp_dir = tempfile.mkdtemp(prefix=prefix,
+            dir=('/dev/shm' if os.path.isdir('/dev/shm') else None))
+    pool = None
+    try:
+        pool = multiprocessing.Pool(workers)
+        yield pool, tmp_dir
+        pool.close()
+        pool.join()
+    finally:
+        if (pool is not None):
+            pool.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 
 #
 # gene matrix refiner           基因矩阵精炼
 # ( internally used in TSData::readmatrix() )
 #
 class GeneMatrix(pd.DataFrame):     #pandas数据
-    def __init__(self):             #__init__用于初始化一个类，self是类的实例
-        super(GeneMatrix, self).__init__()  
+    def __init__(self, data=None):  #__init__用于初始化一个类，self是类的实例
+        super(GeneMatrix, self).__init__(data)
         self._files_read = []
         self._refine_columns = False
         self._refine_index = False
 
-    def load_from_path(self, path, sep=','):
+    # @argument dtype: dtype of matrix values (ex: np.float32)
+    # @argument cache: GeneMatrixCache of parsed files (None: not used)
+    def load_from_path(self, path, sep=',', dtype=None, cache=None):
         if (path not in self._files_read):
-            df = pd.read_csv(path, index_col=0, sep=sep)
+            df = None
+            if (cache is not None):
+                key = cache.key(path, sep, dtype, False, False, dedup=False)
+                df = cache.get(key)
+            if (df is None):
+                df = _parse_matrix_file(path, sep, dtype, False, False, dedup=False)
+                if (cache is not None):
+                    cache.put(key, df)
             self.load_from_df(df)
             self._files_read.append(path)
 
+    # @description load many files at once
+    # files are parsed (in parallel, if workers > 1) and refined,
+    # then assembled with single concat aligned to index of first matrix
+    # (duplicated genename is dropped while assembling, first one is used;
+    #  for duplicated column, last one is used as load_from_path())
+    # it's no-inplace function (returns new GeneMatrix)
+    # @argument dtype: dtype of matrix values (ex: np.float32)
+    # @argument cache: GeneMatrixCache of parsed files (None: not used)
+    #   cached files are not parsed again, and parsed files are added to cache.
+    def load_from_paths(self, paths, sep=',', dtype=None, workers=None, cache=None):
+        fps = []
+        for fp in paths:
+            if (fp not in self._files_read and fp not in fps):
+                fps.append(fp)
+        args = [(fp, sep, dtype, self._refine_columns, self._refine_index) for fp in fps]
+        dfs = [None,] * len(fps)
+        if (cache is not None):
+            for i,a in enumerate(args):
+                dfs[i] = cache.get(cache.key(*a))
+        misses = [i for i in range(len(fps)) if dfs[i] is None]
+        if (workers is None or workers <= 1 or len(misses) <= 1):
+            for i in misses:
+                dfs[i] = _parse_matrix_file(*args[i])
+                if (cache is not None):
+                    cache.put(cache.key(*args[i]), dfs[i])
+        else:
+            # matrices are passed with binary files in memory(tmpfs) if available
+            # (or with cache entry, if cache is used)
+            with WorkerPool(workers, 'GeneMatrix') as (pool, shm_dir):
+                wargs = [args[i] + (shm_dir, cache) for i in misses]
+                for i, (bin_path, is_tmp) in zip(misses, pool.imap(_parse_matrix_worker, wargs)):
+                    if (isinstance(bin_path, pd.DataFrame)):
+                        dfs[i] = bin_path   # (not numeric matrix)
+                        continue
+                    try:
+                        dfs[i] = load_matrix_binary(bin_path)
+                    except (IOError, OSError):
+                        # cache entry is evicted by others in the meantime
+                        dfs[i] = _parse_matrix_file(*args[i])
+                    if (is_tmp):
+                        os.remove(bin_path)
+
+        if (not self.empty):
+            dfs.insert(0, self[~self.index.duplicated(keep='first')])
+        if (len(dfs) == 0):
+            df = pd.DataFrame()
+        else:
+            df = pd.concat(dfs, axis=1, join_axes=[dfs[0].index], copy=False)
+            if (df.columns.has_duplicates):
+                df = df.loc[:, ~df.columns.duplicated(keep='last')]
+        r = GeneMatrix(df)
+        r._files_read = self._files_read + fps
+        r._refine_columns = self._refine_columns
+        r._refine_index = self._refine_index
+        return r
+
     def load_from_df(self, df):
-        if (self._refine_columns):
-            l = [x.replace('.CEL.gz','') for x in df.columns.tolist()]
-            for i in range(len(l)):
-                if (l[i][:3] == "GSM"):
-                    l[i] = l[i].split('_',1)[0]
-            df.columns = l
-        if (self._refine_index):
-            df.index = [x.split('_',1)[0] for x in df.index.tolist()]
+        _refine_matrix(df, self._refine_columns, self._refine_index)
         print df.columns
         self[df.columns] = df
         #self = pd.concat( (self,df), axis=1 )
@@ -116,6 +302,579 @@ class GeneMatrix(pd.DataFrame):     #pandas数据
     def drop_duplicated_index(self):
         return self[~self.index.duplicated(keep='first')]
 
+# (internal function)
+# refine column / index name of matrix (inplace)
+# - columns: '.CEL.gz' removed, and GSM id only ('GSM1234_xxx' -> 'GSM1234')
+# - index: '_' suffix removed
+def _refine_matrix(df, refine_columns, refine_index):
+    if (refine_columns):
+        cols = df.columns.astype(unicode).str.replace('.CEL.gz', '', regex=False)
+        df.columns = np.where(cols.str[:3] == 'GSM', cols.str.split('_', n=1).str[0], cols)
+    if (refine_index):
+        df.index = df.index.astype(unicode).str.split('_', n=1).str[0]
+    return df
+
+# (internal function)
+# parse matrix file for GeneMatrix.load_from_paths()
+# (refined, and duplicated genename is dropped if dedup)
+def _parse_matrix_file(path, sep, dtype, refine_columns, refine_index, dedup=True):
+    if (dtype is not None):
+        cols = pd.read_csv(path, index_col=0, sep=sep, nrows=0).columns
+        dtype = dict([(c, dtype) for c in cols])
+    df = pd.read_csv(path, index_col=0, sep=sep, dtype=dtype)
+    _refine_matrix(df, refine_columns, refine_index)
+    if (dedup):
+        df = df[~df.index.duplicated(keep='first')]
+    return df
+
+# (internal function)
+# process pool worker of GeneMatrix.load_from_paths()
+# parsed matrix is passed through binary file in shm_dir (or cache entry)
+# returns: (path of binary file, whether it's temporary file)
+#   or (DataFrame, False) if matrix cannot be binary (see IsBinaryMatrix())
+def _parse_matrix_worker(args):
+    shm_dir, cache = args[-2:]
+    df = _parse_matrix_file(*args[:-2])
+    if (not IsBinaryMatrix(df)):
+        return (df, False)      # (pickled)
+    if (cache is not None):
+        key = cache.key(*args[:-2])
+        if (cache.put(key, df)):
+            return (cache.getpath(key), False)
+    fd, shm_path = tempfile.mkstemp(suffix='.bin', dir=shm_dir)
+    os.close(fd)
+    save_matrix_binary(shm_path, df)
+    return (shm_path, True)
+
+
+#
+# on-disk cache of parsed matrix files (ex: raw array CSVs of 'Filepath')
+# parsed matrix is stored as binary matrix file (see save_matrix_binary()),
+# keyed with path, size, mtime, separator, dtype and refine flags of source file.
+# least recently used entries are evicted when cache is over maxbytes.
+# (entries are written to temporary file then renamed, so concurrent writers are safe)
+#
+class GeneMatrixCache(object):
+    def __init__(self, path, maxbytes=None):
+        self.path = path
+        self.maxbytes = maxbytes
+        if (not os.path.isdir(path)):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if (not os.path.isdir(path)):
+                    raise
+
+    # (same arguments as _parse_matrix_file())
+    def key(self, fpath, sep, dtype, refine_columns, refine_index, dedup=True):
+        st = os.stat(fpath)
+        # (format version: entries without index/columns dtype are not used)
+        k = json.dumps([2, os.path.abspath(fpath), st.st_size, st.st_mtime, sep,
+            None if dtype is None else np.dtype(dtype).str,
+            bool(refine_columns), bool(refine_index), bool(dedup)])
+        return hashlib.sha1(k).hexdigest()
+
+    def getpath(self, key):
+        return os.path.join(self.path, key + '.bin')
+
+    # returns: matrix, or None if not cached
+    def get(self, key):
+        path = self.getpath(key)
+        try:
+            df = load_matrix_binary(path)
+            os.utime(path, None)    # recently used
+        except (IOError, OSError):
+            return None
+        return df
+
+    # returns: True if cached (non-numeric matrix is not cached)
+    def put(self, key, df):
+        if (not IsBinaryMatrix(df)):
+            return False
+        save_matrix_binary(self.getpath(key), df)
+        self.evict()
+        return True
+
+    # remove least recently used entries, until cache size is under maxbytes
+    # (temporary files left over by killed writers are removed too)
+    def evict(self):
+        if (self.maxbytes is None):
+            return
+        entries = []
+        now = time.time()
+        for fn in os.listdir(self.path):
+            path = os.path.join(self.path, fn)
+            try:
+                st = os.stat(path)
+                if ('.bin.tmp' in fn and now - st.st_mtime > 3600):
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            if (fn.endswith('.bin')):
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum([x[1] for x in entries])
+        for mtime, size, path in sorted(entries):
+            if (total <= self.maxbytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for fn in os.listdir(self.path):
+            if (fn.endswith('.bin')):
+                try:
+                    os.remove(os.path.join(self.path, fn))
+                except OSError:
+                    pass
+
+
+##
+# file opening / compression
+#
+COMPRESS_EXTS = {'.gz': 'gzip', '.xz': 'xz'}
+TSDATA_EXTS = ['.tsd', '.tsd.gz', '.tsd.xz']
+
+def GetCompression(path):
+    return COMPRESS_EXTS.get(os.path.splitext(path)[1])
+
+# @description check filename is TSData file (including compressed)
+def IsTSDataPath(path):
+    for ext in TSDATA_EXTS:
+        if (path.endswith(ext)):
+            return True
+    return False
+
+# (name: file name to detect compression, if path is temporary file)
+def _open_tsd(path, mode, name=None):
+    comp = GetCompression(name or path)
+    if (comp == 'gzip'):
+        return gzip.open(path, mode, compresslevel=6)
+    elif (comp == 'xz'):
+        if (lzma is None):
+            raise Exception('.xz file requires lzma module (backports.lzma for python2)')
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+
+##
+# binary matrix sidecar
+# - first line: signature (###TSDataBinary,0.1)
+# - second line: JSON header (dtype, shape, offsets of each block,
+#   dtype of index / columns to restore numeric names)
+# - matrix block: raw array, column-major (each sample column is contiguous)
+# - index block: genenames joined with newline (utf-8)
+# - columns block: sample names joined with newline (utf-8)
+#
+BINARY_ALIGN = 64
+
+def GetBinaryPath(path):
+    return path + '.bin'
+
+def _align(n, a=BINARY_ALIGN):
+    return (n + a - 1) // a * a
+
+# (numeric names are restored with names_dtype, see _names_dtype())
+def _encode_names(l):
+    return u'\n'.join([repr(x) if isinstance(x, float) else unicode(x) for x in l]).encode('utf-8')
+
+def _decode_names(s, names_dtype=None):
+    if (s == ''):
+        return []
+    l = s.decode('utf-8').split(u'\n')
+    if (names_dtype is None or names_dtype == 'object'):
+        return l
+    names_dtype = np.dtype(names_dtype)
+    if (names_dtype.kind == 'b'):
+        return np.array([x == u'True' for x in l])
+    return np.array(l).astype(names_dtype)
+
+# dtype of index / columns which is restored from names
+# (numeric / bool; others are read as string)
+def _names_dtype(idx):
+    if (idx.dtype.kind in 'iufb'):
+        return idx.dtype.str
+    return 'object'
+
+# @description matrix can be saved as binary matrix file without changing it
+# (all columns in a single numeric dtype)
+def IsBinaryMatrix(df):
+    dtypes = set(df.dtypes)
+    return len(dtypes) == 1 and dtypes.pop().kind in 'fiub'
+
+# @description save matrix(DataFrame) as binary sidecar file
+# written into temporary file first and renamed,
+# so a reader (or memory map) of previous file is not broken.
+def save_matrix_binary(path, df):
+    arr = np.asarray(df.values)
+    if (arr.dtype.kind not in 'fiub'):
+        raise Exception('Binary matrix requires numeric data (%s)' % str(arr.dtype))
+    # column-major raw block == C-ordered transposed array
+    arr_t = np.ascontiguousarray(arr.T)
+    b_index = _encode_names(df.index.tolist())
+    b_columns = _encode_names(df.columns.tolist())
+    hdr = {
+        'dtype': arr.dtype.str,
+        'shape': list(arr.shape),
+        'order': 'F',
+        'index_name': df.index.name,
+        'index_dtype': _names_dtype(df.index),
+        'columns_dtype': _names_dtype(df.columns),
+        'matrix_offset': 0,
+        }
+    # header size depends on offsets; iterate until it settles
+    while True:
+        hdr_str = '###TSDataBinary,0.1\n' + json.dumps(hdr) + '\n'
+        matrix_offset = _align(len(hdr_str))
+        if (matrix_offset == hdr['matrix_offset']):
+            break
+        hdr['matrix_offset'] = matrix_offset
+        hdr['index_offset'] = matrix_offset + arr_t.nbytes
+        hdr['index_length'] = len(b_index)
+        hdr['columns_offset'] = hdr['index_offset'] + len(b_index)
+        hdr['columns_length'] = len(b_columns)
+    path_tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(path_tmp, 'wb') as f:
+        f.write(hdr_str)
+        f.write(' ' * (hdr['matrix_offset'] - len(hdr_str)))
+        arr_t.tofile(f)
+        f.write(b_index)
+        f.write(b_columns)
+    os.rename(path_tmp, path)
+    return True
+
+# @description read header of binary sidecar file
+def read_matrix_binary_header(f):
+    l = f.readline()
+    if (l[:15] != "###TSDataBinary"):
+        raise Exception("Invalid TSData binary Format")
+    return json.loads(f.readline())
+
+# @description load matrix(DataFrame) from binary sidecar file
+# @argument mmap: matrix becomes read-only memory map of the file
+#   (processes mapping same file share single page-cache copy)
+# @argument genes: read only these rows (see SelectGenes())
+# @argument dtype: convert matrix into dtype (copied if differs from file)
+def load_matrix_binary(path, mmap=False, genes=None, dtype=None):
+    with open(path, 'rb') as f:
+        hdr = read_matrix_binary_header(f)
+        rows, cols = hdr['shape']
+        f.seek(hdr['index_offset'])
+        index = _decode_names(f.read(hdr['index_length']), hdr.get('index_dtype'))
+        columns = _decode_names(f.read(hdr['columns_length']), hdr.get('columns_dtype'))
+        if ((mmap or genes is not None) and rows*cols > 0):
+            arr = np.memmap(f, dtype=np.dtype(hdr['dtype']), mode='r',
+                    offset=hdr['matrix_offset'], shape=(cols, rows))
+        else:
+            f.seek(hdr['matrix_offset'])
+            arr = np.fromfile(f, dtype=np.dtype(hdr['dtype']), count=rows*cols)
+            arr = arr.reshape((cols, rows))
+        if (genes is not None):
+            pos = SelectGenes(index, genes)
+            arr = np.array(arr[:, pos])
+            index = [index[i] for i in pos]
+    arr = arr.T
+    if (dtype is not None and arr.dtype != np.dtype(dtype)):
+        arr = arr.astype(dtype)
+    df = pd.DataFrame(arr, index=index, columns=columns)
+    df.index.name = hdr['index_name']
+    return df
+
+
+#
+# section reader
+# ( internally used in TSData::load() )
+# file-like view of [offset, offset+length) bytes of an opened file,
+# so pd.read_csv / json.load can read a section without copying it.
+#
+class TSSectionReader(object):
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.remain = length
+        self.f.seek(offset)
+
+    def read(self, size=-1):
+        if (size is None or size < 0 or size > self.remain):
+            size = self.remain
+        if (size <= 0):
+            return ''
+        s = self.f.read(size)
+        self.remain -= len(s)
+        return s
+
+    def readline(self, size=-1):
+        if (size is None or size < 0 or size > self.remain):
+            size = self.remain
+        if (size <= 0):
+            return ''
+        l = self.f.readline(size)
+        self.remain -= len(l)
+        return l
+
+    # push back last read line
+    def unread(self, l):
+        self.f.seek(-len(l), 1)
+        self.remain += len(l)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        l = self.readline()
+        if (not l):
+            raise StopIteration
+        return l
+    __next__ = next
+
+# @description get row positions of genes from index
+# @argument genes: list of genenames (in given order, missing genes are ignored)
+#   or predicate function (genename -> bool, in index order)
+def SelectGenes(index, genes):
+    index = pd.Index(index)
+    if (callable(genes)):
+        return np.flatnonzero([bool(genes(g)) for g in index])
+    b_first = ~index.duplicated(keep='first')
+    pos = index[b_first].get_indexer(list(genes))
+    return np.flatnonzero(b_first)[pos[pos >= 0]]
+
+# (internal function)
+# dtype which is recorded in metadata and applied to appended samples
+# (only float dtype; integer matrix cannot safely take float samples)
+def _float_dtype(dtype):
+    if (dtype is not None and np.dtype(dtype).kind == 'f'):
+        return np.dtype(dtype)
+    return None
+
+# @description read matrix csv (first column: genename) from section reader
+# @argument dtype: dtype of matrix values (None: inferred by pandas)
+# @argument header: header line, if already read from f
+def read_csv_matrix(f, sep=',', dtype=None, header=None):
+    if (dtype is not None):
+        # set dtype by column name, as index(genename) column is not numeric
+        if (header is None):
+            header = f.readline()
+            f.unread(header)
+        cols = pd.read_csv(BytesIO(header), sep=sep, index_col=0, nrows=0, encoding='utf-8').columns
+        dtype = dict([(c, dtype) for c in cols])
+    return pd.read_csv(f, sep=sep, index_col=0, encoding='utf-8', dtype=dtype)
+
+# @description read ###TSDataMatrix section
+# if row index section is given with genes, only requested rows are read.
+# (rowindex: (offset, length) of ###TSDataRowIndex section)
+# (offset None: f is already a section reader)
+def read_matrix_section(f, offset, length, sep=',', rowindex=None, genes=None, dtype=None):
+    if (genes is None or rowindex is None):
+        if (offset is not None):
+            f = TSSectionReader(f, offset, length)
+        df = read_csv_matrix(f, sep, dtype)
+        if (genes is not None):
+            df = df.iloc[SelectGenes(df.index, genes)]
+        return df
+    df_ri = pd.read_csv(TSSectionReader(f, rowindex[0], rowindex[1]), index_col=0, encoding='utf-8')
+    pos = SelectGenes(df_ri.index, genes)
+    # read rows in file order, then restore requested order
+    pos_order = np.argsort(pos, kind='mergesort')
+    row_offsets = df_ri['offset'].values[pos[pos_order]]
+    row_lengths = df_ri['length'].values[pos[pos_order]]
+    buf = [TSSectionReader(f, offset, length).readline()]
+    for row_offset, row_length in zip(row_offsets, row_lengths):
+        f.seek(offset + row_offset)
+        buf.append(f.read(row_length))
+    df = read_csv_matrix(BytesIO(''.join(buf)), sep, dtype, buf[0])
+    return df.iloc[np.argsort(pos_order)]
+
+# @description read ###TSDataMatrix section of compressed TSData file
+# (file is decompressed again from the beginning, as stream is not seekable)
+def read_stream_matrix(path, sep=',', genes=None, dtype=None):
+    with _open_tsd(path, 'rb') as f:
+        f.readline()    # signature
+        for cmd, sec in IterSections(f):
+            if (cmd == '###TSDataMatrix'):
+                return read_matrix_section(sec, None, None, sep, None, genes, dtype)
+    return pd.DataFrame()
+
+# @description write ###TSDataMatrix section (by row chunks)
+# returns: TOC entry, row index(DataFrame: offset, length of each row)
+def _write_matrix_section(f, df, chunksize=10000):
+    f.write('###TSDataMatrix\n')
+    offset = f.tell()
+    header = df.iloc[:0].to_csv(encoding="utf-8")
+    if (isinstance(header, unicode)):
+        header = header.encode('utf-8')
+    f.write(header)
+    row_lengths = []
+    for i in range(0, len(df.index), chunksize):
+        data = df.iloc[i:i+chunksize].to_csv(header=False, encoding="utf-8")
+        if (isinstance(data, unicode)):
+            data = data.encode('utf-8')
+        f.write(data)
+        row_lengths += [len(l)+1 for l in data.split('\n')[:-1]]
+    row_lengths = np.array(row_lengths, dtype=np.int64)
+    row_offsets = len(header) + np.cumsum(row_lengths) - row_lengths
+    df_ri = pd.DataFrame({'offset': row_offsets, 'length': row_lengths},
+            index=df.index, columns=['offset', 'length'])
+    return ('###TSDataMatrix', offset, f.tell() - offset), df_ri
+
+#
+# stream section reader
+# ( internally used in TSData::load() for compressed file )
+# file-like view of lines until next section line, read in one pass.
+#
+class TSStreamSectionReader(object):
+    def __init__(self, f):
+        self.f = f
+        self.offset = None      # not seekable
+        self.buf = ''
+        self.pending = None     # section line which ends this section
+        self.done = False
+
+    def readline(self, size=-1):
+        if (self.buf):
+            l = self.buf
+            self.buf = ''
+            return l
+        if (self.done):
+            return ''
+        l = self.f.readline()
+        if (not l or _is_section_line(l)):
+            if (l):
+                self.pending = l
+            self.done = True
+            return ''
+        return l
+
+    def read(self, size=-1):
+        r = []
+        n = 0
+        while (size is None or size < 0 or n < size):
+            l = self.readline()
+            if (not l):
+                break
+            r.append(l)
+            n += len(l)
+        r = ''.join(r)
+        if (size is not None and size >= 0 and len(r) > size):
+            self.buf = r[size:]
+            r = r[:size]
+        return r
+
+    # push back last read line
+    def unread(self, l):
+        self.buf = l + self.buf
+
+    def drain(self):
+        self.buf = ''
+        while (self.readline()):
+            pass
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        l = self.readline()
+        if (not l):
+            raise StopIteration
+        return l
+    __next__ = next
+
+# @description iterate sections of TSData stream in one pass
+# (file position should be right after the signature line)
+# yields: (sectionname, section reader). empty section is skipped.
+def IterSections(f):
+    cmd = "###TSJsonData"
+    implicit = True     # first section may be written with section line
+    while True:
+        sec = TSStreamSectionReader(f)
+        l = sec.readline()
+        if (l):
+            sec.buf = l
+            yield cmd, sec
+        elif (not implicit):
+            print "Section %s is empty, ignored." % cmd
+        implicit = False
+        sec.drain()
+        if (sec.pending is None):
+            break
+        cmd = sec.pending.strip()
+
+def _is_section_line(l):
+    return (l[:9] == "###TSData" or l[:13] == "###TSJsonData")
+
+# @description scan section boundaries of TSData file
+# (file position should be right after the signature line)
+# returns: [ (sectionname, byte offset, byte length) ]
+# first section (without section line) is always ###TSJsonData.
+def ScanSections(f):
+    r = []
+    cmd = "###TSJsonData"
+    pos = f.tell()
+    start = pos
+    while True:
+        l = f.readline()
+        if (not l):
+            break
+        if (_is_section_line(l)):
+            if (r or pos > start):  # first section may be written with section line
+                r.append((cmd, start, pos - start))
+            cmd = l.strip()
+            start = pos + len(l)
+        pos += len(l)
+    if (r or pos > start):
+        r.append((cmd, start, pos - start))
+    return r
+
+# @description read table of contents of TSData file
+# (file position should be right after the signature line)
+# returns: same as ScanSections(), or None if file has no TOC.
+#   TOC which is not written completely (ex: interrupted save) is ignored too,
+#   and file position is moved right after TOC to scan sections.
+def ReadTOC(f):
+    pos = f.tell()
+    l = f.readline()
+    if (l.strip() != "###TSDataTOC"):
+        f.seek(pos)
+        return None
+    r = []
+    while True:
+        pos = f.tell()
+        l = f.readline()
+        if (not l or l[:3] == "###"):
+            break
+        name, offset, length = l.strip().split(',')
+        r.append(("###" + name, int(offset), int(length)))
+    # each entry should point at data right after its section line
+    f.seek(0, 2)
+    size = f.tell()
+    for name, offset, length in r:
+        if (offset - len(name) - 1 < pos or offset + length > size):
+            break
+        f.seek(offset - len(name) - 1)
+        if (f.read(len(name) + 1) != name + '\n'):
+            break
+    else:
+        return r
+    print "TOC is invalid, sections are scanned."
+    f.seek(pos)
+    return None
+
+# fixed width, so TOC can be rewritten after sections are written
+def _format_toc(toc):
+    return ''.join(['%s,%016d,%016d\n' % (name[3:], offset, length)
+        for name, offset, length in toc])
+
+def _write_section(f, name, data):
+    if (isinstance(data, unicode)):
+        data = data.encode('utf-8')
+    f.write(name + '\n')
+    offset = f.tell()
+    f.write(data)
+    return (name, offset, len(data))
+
 
 # (DEPRECIATED method)
 class TSCondition(object):
@@ -193,6 +952,112 @@ class TSDict(dict):
             if (self[k] == None):
                 self[k] = ''
 
+#
+# LRU cache of lazily loaded matrices
+# (matrix of least recently used TSData is dropped, and read again at next access)
+# maxcount: max count of resident matrices / maxbytes: max total bytes of them
+#
+class TSMatrixCache(object):
+    def __init__(self, maxcount=None, maxbytes=None):
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        self.items = collections.OrderedDict()     # id(tsd): (tsd, bytes)
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def touch(self, tsd):
+        k = id(tsd)
+        if (k in self.items):
+            self.items[k] = self.items.pop(k)
+
+    def push(self, tsd):
+        self.discard(tsd)
+        n = int(tsd._df.memory_usage(index=False).sum())
+        self.items[id(tsd)] = (tsd, n)
+        self.nbytes += n
+        # (most recently pushed matrix is never dropped)
+        while (len(self.items) > 1 and
+                ((self.maxcount is not None and len(self.items) > self.maxcount) or
+                 (self.maxbytes is not None and self.nbytes > self.maxbytes))):
+            self._drop(self.items.popitem(last=False)[1])
+
+    def discard(self, tsd):
+        v = self.items.pop(id(tsd), None)
+        if (v is not None):
+            self.nbytes -= v[1]
+
+    def clear(self):
+        while (len(self.items) > 0):
+            self._drop(self.items.popitem(last=False)[1])
+
+    def _drop(self, v):
+        tsd, n = v
+        self.nbytes -= n
+        tsd._df = None
+
+
+#
+# replicate-group index of TSData samples (see TSData.getSeriesGroups())
+# - codes: group number of each sample (column of df_meta), -1 if not grouped
+# - keys / labels: (SeriesID, Time) / 'SeriesID_Time' of each group, ordered by time
+# - hours: time of each group in hours (NaN if unrecognized)
+# - counts / starts: sample count of each group, and its start in cols
+# - cols: column positions, sorted by group
+# - series: SeriesIDs in order of appearance, series_cols: column positions of each
+# - timepoints / replicates: ordered timepoints / replicate counts of each series
+#
+class TSSeriesGroups(object):
+    def __init__(self, df_meta, hours=None):
+        if (hours is None):
+            hours = ParseTimeArray(df_meta.loc['Time'].values, errors='coerce')
+        self.codes, self.keys = GroupSeries(
+                df_meta.loc['SeriesID'].values, df_meta.loc['Time'].values, hours=hours)
+        self.labels = ['%s_%s' % k for k in self.keys]
+        valid = np.flatnonzero(self.codes >= 0)
+        self.cols = valid[np.argsort(self.codes[valid], kind='mergesort')]
+        self.counts = np.bincount(self.codes[valid], minlength=len(self.keys))
+        self.starts = np.concatenate(([0,], np.cumsum(self.counts)[:-1])).astype(np.int64)
+        self.hours = hours[self.cols[self.starts]] if len(self.keys) > 0 else np.empty(0)
+        sample_ids = df_meta.columns[self.cols]
+        self.samples = [sample_ids[b:b+c].tolist() for b,c in zip(self.starts, self.counts)]
+
+        sid_codes, sid_uniq = pd.factorize(df_meta.loc['SeriesID'].values)
+        order = np.argsort(sid_codes, kind='mergesort')
+        bounds = np.searchsorted(sid_codes[order], np.arange(len(sid_uniq)+1))
+        self.series = sid_uniq.tolist()
+        self.series_cols = dict([(sid, order[bounds[i]:bounds[i+1]])
+            for i,sid in enumerate(self.series)])
+        self.timepoints = dict([(sid, []) for sid in self.series])
+        self.replicates = dict([(sid, []) for sid in self.series])
+        for (sid, t), cnt in zip(self.keys, self.counts):
+            self.timepoints[sid].append(t)
+            self.replicates[sid].append(int(cnt))
+
+
+#
+# hash index of genenames of matrix (see TSData.LookupGenes())
+# normalized genename -> row position (first row, if duplicated)
+#
+class TSGeneIndex(object):
+    def __init__(self, index, normalize=True):
+        self.index = index      # index of matrix which this is built from
+        self.normalize = normalize
+        names = NormalizeGeneNames(index) if normalize else np.asarray(index, dtype=object)
+        names = pd.Index(names)
+        first = ~names.duplicated(keep='first')
+        self.keys = names[first]
+        self.pos = np.flatnonzero(first)
+
+    # returns: row position of each gene (-1 if not found)
+    def lookup(self, genes):
+        if (self.normalize):
+            genes = NormalizeGeneNames(genes)
+        i = self.keys.get_indexer(np.asarray(genes, dtype=object))
+        return np.append(self.pos, -1)[i]
+
+
 ##
 # TSData
 # @description: main class that loads / saves / calculates Timeseries differential
@@ -205,9 +1070,11 @@ class TSData(object):
             'date':None,        # generated or measured date
             'desc':'',          # description of data
             'version': 0.2,
+            'dtype': None,      # dtype of matrix values (ex: float32)
             })
 
     def __init__(self):
+        self._df_cache = None
         self.metadata_init()
 
         #
@@ -243,7 +1110,127 @@ class TSData(object):
         self.cur_path = None
         self.workdir = None
         self.sep = ','
+        self.binary = False     # save matrix into binary sidecar file
+        self._saved_samples = None  # samples already written in cur_path (for save_append)
+        self._saved_version = None  # format version of cur_path (for save_append)
+        self._genes_loaded = None   # genes option of load(), if matrix is partially loaded
+        self.dtype = None       # dtype of matrix when reading (None: as recorded / parsed)
+
+
+    # replicate-group index and time in hours are built at first use,
+    # and dropped when df_meta is set.
+    # (in-place modification of df_meta should call _invalidate_groups())
+    @property
+    def df_meta(self):
+        return self._df_meta
+
+    @df_meta.setter
+    def df_meta(self, v):
+        self._df_meta = v
+        self._invalidate_groups()
+
+    def _invalidate_groups(self):
+        self._groups = None
+        self._time_hours = None
+
+    # @description get time of each sample in hours (cached)
+    # (NaN if time is missing or unrecognized)
+    def getTimeHours(self):
+        if (self._time_hours is None):
+            self._time_hours = ParseTimeArray(self.df_meta.loc['Time'].values, errors='coerce')
+        return self._time_hours
+
+    # matrix is loaded at first access in case of lazy load
+    # (_df_source: where to read matrix from, None if already loaded)
+    # with matrix cache (see TSMatrixCache), matrix may be dropped and read again.
+    @property
+    def df(self):
+        if (self._df is None):
+            self._df = self._read_df_source()
+            if (self._df_cache is None):
+                self._df_source = None
+                self._df_deltas = []
+                self._df_columns = None
+            else:
+                # source is kept, as matrix can be dropped by cache later
+                self._df_cache.push(self)
+        elif (self._df_cache is not None):
+            self._df_cache.touch(self)
+        return self._df
+
+    @df.setter
+    def df(self, v):
+        self._gene_index = {}
+        if (self._df_cache is not None):
+            self._df_cache.discard(self)
+            self._df_cache = None
+        self._df = v
+        self._df_source = None
+        self._df_deltas = []
+        self._df_columns = None    # columns to select after reading (by filter())
+
+    # @description set LRU cache which limits resident matrices
+    # (only for lazy loaded TSData)
+    def SetMatrixCache(self, cache):
+        if (self._df_source is None):
+            return False
+        self._df_cache = cache
+        if (self.IsMatrixLoaded()):
+            cache.push(self)
+        return True
+
+    def IsMatrixLoaded(self):
+        return self._df is not None
 
+    # @description write matrix into binary file, and map it back lazily (read-only).
+    # used to pass matrix to other process without pickling it.
+    # returns False if matrix is empty, not numeric, or already mapped from binary file.
+    def MapMatrix(self, path):
+        if (not self.IsMatrixLoaded() and self._df_source[0] == 'binary'):
+            return False
+        df = self.df
+        if (df.empty or not IsBinaryMatrix(df)):
+            return False
+        save_matrix_binary(path, df)
+        self.df = pd.DataFrame()    # (reset lazy / cache state)
+        self._df = None
+        self._df_source = ('binary', path, None)
+        return True
+
+    # matrix exists (without reading lazy matrix)
+    def HasMatrix(self):
+        if (self._df is None):
+            return True
+        return not self._df.empty
+
+    def _read_df_source(self):
+        src = self._df_source
+        if (src[0] == 'binary'):
+            df = load_matrix_binary(src[1], mmap=True, genes=src[2], dtype=self.dtype)
+        elif (src[0] == 'stream'):
+            df = read_stream_matrix(src[1], src[2], src[3], self.dtype)
+        else:
+            with open(src[1], 'rb') as f:
+                df = read_matrix_section(f, src[2], src[3], src[4], src[5], src[6], self.dtype)
+        df = self._merge_deltas(df)
+        if (self._df_columns is not None):
+            df = df[self._df_columns]
+        self._check_matrix(df)
+        return df
+
+    # merge matrix of delta sections (appended samples)
+    def _merge_deltas(self, df):
+        deltas = self._df_deltas
+        if (len(deltas) == 0):
+            return df
+        if (df.empty):
+            return pd.concat(deltas, axis=1)
+        return pd.concat([df] + [d.reindex(df.index) for d in deltas], axis=1)
+
+    def _check_matrix(self, df):
+        if (not df.empty):
+            if (len(df.columns) != len(self.df_meta.columns)):
+                raise Exception('DataHeader and DataMatrix column count is different!')
 
     def __str__(self):
         # tell how many samples / conditions are existing
@@ -295,6 +1282,102 @@ class TSData(object):
     def getExpression(self, gn):
         return self.df.loc()[gn]
 
+    # @description get hash index of genenames (cached)
+    # (rebuilt only if index of matrix is changed)
+    def getGeneIndex(self, normalize=True):
+        idx = self._gene_index.get(normalize)
+        if (idx is None or idx.index is not self.df.index):
+            idx = TSGeneIndex(self.df.index, normalize)
+            self._gene_index[normalize] = idx
+        return idx
+
+    # @description lookup many genes at once
+    # @argument genes: list of genenames
+    # @argument normalize: case-folding and '_' suffix removal of genenames
+    # returns: dict
+    # - positions: row positions of found genes (in order of given genes)
+    # - genes: found genes (as given)
+    # - matrix: expression of found genes (DataFrame, index: found genes)
+    # - missing: genes not found
+    def LookupGenes(self, genes, normalize=True):
+        genes = list(genes)
+        pos = self.getGeneIndex(normalize).lookup(genes)
+        found = pos >= 0
+        genes_found = [g for g,b in zip(genes, found) if b]
+        positions = pos[found]
+        mat = pd.DataFrame(np.take(self.df.values, positions, axis=0),
+                index=genes_found, columns=self.df.columns)
+        return {
+            'positions': positions,
+            'genes': genes_found,
+            'matrix': mat,
+            'missing': [g for g,b in zip(genes, found) if not b],
+            }
+
+    # @description group samples by (SeriesID, Time)
+    # returns: TSSeriesGroups (cached until df_meta is changed)
+    def getSeriesGroups(self):
+        if (self._groups is None):
+            self._groups = TSSeriesGroups(self.df_meta, self.getTimeHours())
+        return self._groups
+
+    #
+    # get replication statistics of each gene, for each (SeriesID, Time) group
+    # (groups are reduced at once after single sort of samples)
+    #
+    # returns: dict
+    # - keys: [(SeriesID, Time)], labels: ['SeriesID_Time'] of groups
+    # - count: number of samples for each group (array)
+    # - samples: [[SampleID]] for each group
+    # - sum, mean, min, max, std, m2: DataFrame (index: genes, columns: labels)
+    #   (std is NaN if count <= ddof; m2 is sum of squared deviation)
+    #
+    # gn: specific gene-name (or list of gene-names) to get statistics
+    # ddof: delta degrees of freedom of std
+    #
+    def getSeriesStats(self, gn=None, ddof=1):
+        g = self.getSeriesGroups()
+        keys, labels, counts, starts = g.keys, g.labels, g.counts, g.starts
+        samples = g.samples
+        sample_ids = self.df_meta.columns[g.cols]
+
+        df = self.df
+        if (gn is not None):
+            df = df.loc[gn if isinstance(gn, list) else [gn,]]
+        if (df.empty):
+            X = np.empty((len(df.index), len(g.cols)))
+        else:
+            pos = df.columns.get_indexer(sample_ids)
+            if ((pos < 0).any()):
+                raise Exception('Matrix does not have sample: %s' % ','.join(sample_ids[pos < 0]))
+            X = df.values[:, pos]
+
+        if (len(keys) > 0):
+            _sum = np.add.reduceat(X, starts, axis=1, dtype=np.float64)
+            _min = np.minimum.reduceat(X, starts, axis=1)
+            _max = np.maximum.reduceat(X, starts, axis=1)
+        else:
+            _sum = _min = _max = np.empty((X.shape[0], 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _mean = _sum / counts
+            if (len(keys) > 0):
+                dev = X - np.repeat(_mean, counts, axis=1)
+                _m2 = np.add.reduceat(dev * dev, starts, axis=1)
+            else:
+                _m2 = np.empty((X.shape[0], 0))
+            _std = np.sqrt(_m2 / (counts - ddof))
+        _std[:, counts <= ddof] = np.nan
+
+        # (accumulated in float64, then returned in float dtype of matrix)
+        if (X.dtype.kind == 'f'):
+            _sum, _mean, _std, _m2 = [v.astype(X.dtype, copy=False) for v in (_sum, _mean, _std, _m2)]
+        mk = lambda v: pd.DataFrame(v, index=df.index, columns=labels)
+        return {
+            'keys': keys, 'labels': labels, 'count': counts, 'samples': samples,
+            'sum': mk(_sum), 'mean': mk(_mean), 'min': mk(_min), 'max': mk(_max),
+            'std': mk(_std), 'm2': mk(_m2),
+            }
+
     #
     # get information about replication (means same series & timepoint)
     # and about genemic expression (if provided)
@@ -306,42 +1389,29 @@ class TSData(object):
     # gn: specific gene-name to get avg/min/max/std
     #
     def getSeries(self, gn=None):
-        df_rep = pd.DataFrame(index=['count','time','avg','min','max','std','samples'])
+        st = self.getSeriesStats(gn)
+        counts = st['count']
+        # summary of each group (combined from per-gene statistics)
+        n = st['sum'].shape[0] * counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _avg = st['sum'].values.sum(axis=0) / n
+            _m2 = st['m2'].values.sum(axis=0) + \
+                    (counts * (st['mean'].values - _avg) ** 2).sum(axis=0)
+            _std = np.sqrt(_m2 / (n - 1))
+        _std[counts <= 1] = 0
+        if (st['sum'].shape[0] > 0):
+            _min = st['min'].values.min(axis=0)
+            _max = st['max'].values.max(axis=0)
+        else:
+            _min = _max = np.full(len(counts), np.nan)
+        df_rep = pd.DataFrame([
+            counts.tolist(),
+            [k[1] for k in st['keys']],
+            _avg.tolist(), _min.tolist(), _max.tolist(), _std.tolist(),
+            [','.join(x) for x in st['samples']],
+            ], index=['count','time','avg','min','max','std','samples'],
+            columns=st['labels'])
         df_rep.index.name = 'SeriesID'
-        # group by 'SeriesID' and 'Time'
-        groups = list(self.df_meta.transpose().groupby(['SeriesID','Time']))
-        # sort once more (as timepoint is wrong recognized as string)
-        def sort_group_time(a,b):
-            r = float(a[0][1]) - float(b[0][1])
-            if (r > 0):
-                return 1
-            elif (r == 0):
-                return 0
-            else:
-                return -1
-        groups.sort(sort_group_time)
-        for k,df_rep_s in groups:
-            samples = df_rep_s.transpose().columns
-            cnt = len(samples)
-            sample_str = ','.join( samples.tolist() )
-            time = k[1]
-            # split samples (row)
-            df_expr_split = self.df
-            if (gn is not None):
-                df_expr_split = self.getExpression(gn)
-            # split samples (column)
-            df_expr_split = np.array(self.df[samples])
-            # get statistics from split
-            _avg = np.mean(df_expr_split)
-            _min = np.min(df_expr_split)
-            _max = np.max(df_expr_split)
-            _std = 0
-            if (df_expr_split.shape[1] > 1):
-                _std = np.std(df_expr_split, ddof=1)
-            # add new record
-            df_rep[k[0]+'_'+k[1]] = [
-                cnt, time, _avg, _min, _max, _std, sample_str
-                ]
         return df_rep
     # @description (DEPRECIATED)
     def getReplication(self, gn=None, force_convert=None):
@@ -349,22 +1419,19 @@ class TSData(object):
 
     def fix(self):
         # sort series metadata : by seriesname / time / replication
-        def sort_manually(a,b):
-            al = (a[1],a[2],a[3]) 
-            bl = (b[1],b[2],b[3])
-            if (al > bl):
-                return 1
-            else:
-                return 0
-        col_sort_data = zip(
+        # (time is compared in hours, unrecognized time comes last)
+        num_key = lambda v: (1, 0.0) if np.isnan(v) else (0, v)
+        col_sort = zip(
             self.df_meta.columns.tolist(),
-            self.df_meta['SeriesID'].tolist(),
-            self.df_meta['Time'].tolist(),
-            self.df_meta['Replication'].tolist())
-        col_sort.sort(sort_manually)
+            self.df_meta.loc['SeriesID'].tolist(),
+            [num_key(h) for h in self.getTimeHours()],
+            [unicode(t) for t in self.df_meta.loc['Time']],
+            [num_key(r) for r in pd.to_numeric(self.df_meta.loc['Replication'], errors='coerce')])
+        col_sort.sort(key=lambda x: x[1:])
         cols = [x[0] for x in col_sort]
         self.df_meta = self.df_meta[cols]
-        self.df = self.df[ self.df_meta.columns ]
+        if (not self.df.empty):
+            self.df = self.df[ self.df_meta.columns ]
         # last: check validation of datatable top-column
         if (self.df.index.name):
             self.df.index.name = self.df.index.name.replace('#','_')
@@ -377,15 +1444,23 @@ class TSData(object):
         self.df_meta = pd.concat([self.df_meta, df_meta_new], axis=1, join_axes=[self.df_meta.index])
 
     # @description load for general TS file
-    def load(self, path):
+    # @argument lazy: matrix is not read until first access of 'df'.
+    #   binary matrix is mapped into memory (read-only) in that case,
+    #   and compressed file is decompressed again at the access.
+    # @argument genes: read only these genes(rows) of matrix.
+    #   list of genenames, or predicate function (genename -> bool)
+    # @argument dtype: dtype of matrix values (ex: np.float32).
+    #   if None, dtype recorded in metadata is used.
+    def load(self, path, lazy=False, genes=None, dtype=None):
         # internal function
         _cond = {}
-        def save_section_v01(sectionname, mat_data):
+        _deltas = []
+        def save_section_v01(sectionname, sec):
             if (sectionname == "###TSJsonData"):
-                self.metadata = json.loads(mat_data)
+                self.metadata = json.load(sec)
             elif (sectionname == "###TSDataCondition"):
                 # DEPRECIATED section, need converting to dataframe
-                conds = json.loads(mat_data)
+                conds = json.load(sec)
                 for cid,dat in conds.items():
                     tscond = TSCondition()
                     tscond.load(dat)
@@ -393,39 +1468,66 @@ class TSData(object):
                     _cond[cid] = tscond
             elif (sectionname == "###TSDataHeader"):
                 # add column if not exists
-                _uni = unicode(mat_data.decode('utf-8'))
-                df_meta_old = pd.read_csv(StringIO(_uni), sep=self.sep, index_col=0)
+                df_meta_old = pd.read_csv(sec, sep=self.sep, index_col=0, encoding='utf-8')
                 # need to change some row name
                 df_meta_old = df_meta_old.rename(index={'CID':'SeriesID', 'Title':'Desc'})
                 # merge df_meta, with adding column & left-innerjoin row
                 #self.df_meta = pd.concat([self.df_meta, df_meta_old], axis=1, join_axes=[self.df_meta.index])
                 self.appendsample(df_meta_old)
             elif (sectionname == "###TSDataMatrix"):
-                _uni = unicode(mat_data.decode('utf-8'))
-                self.df = pd.read_csv(StringIO(_uni), sep=self.sep, index_col=0)
+                self.df = read_csv_matrix(sec, self.sep, self.dtype)
+                if (genes is not None):
+                    self.df = self.df.iloc[SelectGenes(self.df.index, genes)]
             elif (sectionname == "###TSDataEvent"):
                 print("###TSDataEvent section is not currently supported, sorry.")
 
-        def save_section_v02(sectionname, mat_data):
+        def save_section_v02(sectionname, sec):
             if (sectionname == "###TSJsonData"):
-                self.metadata = json.loads(mat_data)
+                self.metadata = json.load(sec)
+                if (self.dtype is None):
+                    self.dtype = self.metadata.get('dtype')
             elif (sectionname == "###TSDataHeader"):
-                _uni = unicode(mat_data.decode('utf-8'))
-                self.df_meta = pd.read_csv(StringIO(_uni), sep=self.sep, index_col=0)
+                self.df_meta = pd.read_csv(sec, sep=self.sep, index_col=0, encoding='utf-8')
+            elif (sectionname == "###TSDataMatrix" and sec.offset is None and lazy):
+                # streamed section is read again from the beginning of file
+                self._df = None
+                self._df_source = ('stream', path, self.sep, genes)
+            elif (sectionname == "###TSDataMatrix" and sec.offset is None):
+                self.df = read_matrix_section(sec, None, None, self.sep, None, genes, self.dtype)
             elif (sectionname == "###TSDataMatrix"):
-                _uni = unicode(mat_data.decode('utf-8'))
-                self.df = pd.read_csv(StringIO(_uni), sep=self.sep, index_col=0)
+                self._df = None
+                self._df_source = ('text', path, sec.offset, sec.length, self.sep,
+                        secs.get('###TSDataRowIndex'), genes)
+            elif (sectionname == "###TSDataBinary"):
+                binfo = json.load(sec)
+                binpath = os.path.join(self.workdir, binfo['path'])
+                if (lazy or genes is not None):
+                    self._df = None
+                    self._df_source = ('binary', binpath, genes)
+                else:
+                    self.df = load_matrix_binary(binpath, dtype=self.dtype)
+                self.binary = True
+            elif (sectionname == "###TSDataRowIndex"):
+                pass    # used with ###TSDataMatrix section
+            elif (sectionname == "###TSDataDeltaHeader"):
+                self.appendsample(pd.read_csv(sec, sep=self.sep, index_col=0, encoding='utf-8'))
+            elif (sectionname == "###TSDataDeltaMatrix"):
+                _deltas.append(read_csv_matrix(sec, self.sep, _float_dtype(self.dtype)))
             elif (sectionname == "###TSDataEvent"):
                 print("###TSDataEvent section is not currently supported, sorry.")
 
+        self.df = pd.DataFrame()
         self.cur_path = path
+        self.binary = False
+        self.dtype = dtype
         self.workdir = os.path.dirname(path)
         save_section = save_section_v02
+        compressed = GetCompression(path) is not None
         if (self.cur_path[-4:] == '.txt'):
             self.sep = '\t'
         else:
             self.sep = ','
-        with open(path, "r") as f:
+        with _open_tsd(path, "rb") as f:
             l = f.readline()
             # check signature
             if (l[:9] != "###TSData"):
@@ -436,27 +1538,31 @@ class TSData(object):
                 if (self.metadata['version'] < 0.2):
                     save_section = save_section_v01
             self.metadata_init()
-            # read all section to end of the file
-            cmd = "###TSJsonData"
-            mat_data = ""
-            for l in f.readlines():
-                l = l.strip()
-                if (l[:9] == "###TSData"):
-                    if (mat_data == ""):
-                        print "Section %s is empty, ignored." % cmd
-                    else:
-                        # new section starts, save previous section
-                        save_section(cmd, mat_data)
-                        cmd = l
-                        mat_data = ""
+            if (compressed):
+                # decompress and parse section by section, in one pass.
+                for cmd, sec in IterSections(f):
+                    save_section(cmd, sec)
+            else:
+                # find section boundaries first (from TOC if exists),
+                # then hand each byte range of the opened file to the parser.
+                sections = ReadTOC(f)
+                if (sections is None):
+                    sections = ScanSections(f)
                 else:
-                    mat_data += l + '\n'
-            # if previous section remains, then save.
-            if (mat_data != ""):
-                save_section(cmd, mat_data)
+                    # appended sections (see save_append()) are not in TOC
+                    f.seek(max([x[1]+x[2] for x in sections]))
+                    sections += ScanSections(f)
+                secs = dict([(x[0], x[1:]) for x in sections])
+                for cmd, offset, length in sections:
+                    if (length == 0):
+                        print "Section %s is empty, ignored." % cmd
+                        continue
+                    save_section(cmd, TSSectionReader(f, offset, length))
             # fin
             f.close()
 
+        self._saved_version = self.metadata['version']
+        self._genes_loaded = genes
         # COMPATIBILITY WORK
         if (self.metadata['version'] == 0.1):
             # make temporary dict for (sample - series) pair
@@ -471,12 +1577,24 @@ class TSData(object):
                 self.df_meta[sampleid]['SeriesID'] = _seriesid
                 for k,d in _metadata.items():
                     self.df_meta[sampleid][k] = d
+            self._invalidate_groups()
             self.metadata['version'] = 0.2
 
-        # sanity check
-        if (not self.df.empty):
-            if (len(self.df.columns) != len(self.df_meta.columns)):
-                raise Exception('DataHeader and DataMatrix column count is different!')
+        if (_float_dtype(self.dtype) is not None):
+            self.metadata['dtype'] = str(_float_dtype(self.dtype))
+
+        # merge appended samples (lazy matrix is merged when it's read)
+        self._df_deltas = _deltas
+        if (self.IsMatrixLoaded()):
+            self._df = self._merge_deltas(self._df)
+            self._df_deltas = []
+        elif (not lazy):
+            self.df
+        self._saved_samples = self.df_meta.columns.tolist()
+
+        # sanity check (lazy matrix is checked when it's read)
+        if (self.IsMatrixLoaded()):
+            self._check_matrix(self.df)
         # check and rematch column order
         #self.df = self.df[ self.df_meta.columns ]
         # fix order / wrong character
@@ -496,34 +1614,146 @@ class TSData(object):
 
 
     # @description save as TS file format
-    def save(self, path=None):
+    # @argument binary: save matrix into binary sidecar file.
+    #   if None, keeps the mode of the loaded file.
+    # raise Exception if matrix is partially loaded (load() with genes)
+    # and saved into the same file, as other genes would be lost.
+    def save(self, path=None, binary=None):
         if (path == None):
             path = self.cur_path
             if (path == None):
                 raise Exception("Should once open a file if None-path specified")
+        if (self._genes_loaded is not None and path == self.cur_path):
+            raise Exception('Cannot overwrite file with partially loaded matrix (genes); save to other path')
+        # (lazy matrix should be read before the file is rewritten)
+        df = self.df
+        # check before the file is touched
+        if (binary is None):
+            binary = self.binary
+        if (binary and not df.empty and not IsBinaryMatrix(df)):
+            raise Exception('Binary matrix requires numeric data (%s)' % ','.join(set(map(str, df.dtypes))))
         self.cur_path = path
-        
-        with open(path, "w") as f:
-            f.write('###TSData,0.2\n')
-            f.write( json.dumps(self.metadata )+'\n' )
-            f.write('###TSDataHeader\n')
-            f.write( self.df_meta.to_csv(encoding="utf-8") )
-            if (not self.df.empty):   # only add matrix data if dataframe exists
-                f.write('###TSDataMatrix\n')
-                f.write( self.df.to_csv(encoding="utf-8") ) 
+        self.binary = binary
+        binpath = GetBinaryPath(path)
+        # compressed stream is written without TOC / row index
+        compressed = GetCompression(path) is not None
+        # record (float) dtype of matrix, to be read in same dtype
+        dtypes = set(df.dtypes)
+        if (len(dtypes) == 1 and _float_dtype(list(dtypes)[0]) is not None):
+            self.metadata['dtype'] = str(dtypes.pop())
+        elif (not df.empty):
+            self.metadata.pop('dtype', None)
+
+        sections = ['###TSJsonData', '###TSDataHeader']
+        source = None   # where matrix can be read again after saving
+        if (not df.empty):   # only add matrix data if dataframe exists
+            if (self.binary):
+                sections.append('###TSDataBinary')
+            elif (compressed):
+                sections.append('###TSDataMatrix')
+            else:
+                sections += ['###TSDataMatrix', '###TSDataRowIndex']
+
+        # written into temporary file first and renamed,
+        # so the file is not broken if saving fails.
+        path_tmp = '%s.tmp%d' % (path, os.getpid())
+        try:
+            with _open_tsd(path_tmp, "wb", path) as f:
+                f.write('###TSData,0.2\n')
+                if (not compressed):
+                    # table of contents (rewritten after sections are written)
+                    f.write('###TSDataTOC\n')
+                    toc_offset = f.tell()
+                    f.write( _format_toc([(x, 0, 0) for x in sections]) )
+                toc = []
+                toc.append( _write_section(f, '###TSJsonData', json.dumps(self.metadata)+'\n') )
+                toc.append( _write_section(f, '###TSDataHeader', self.df_meta.to_csv(encoding="utf-8")) )
+                if ('###TSDataBinary' in sections):
+                    save_matrix_binary(binpath, df)
+                    toc.append( _write_section(f, '###TSDataBinary',
+                        json.dumps({'path': os.path.basename(binpath)})+'\n') )
+                    source = ('binary', binpath, None)
+                elif ('###TSDataMatrix' in sections):
+                    toc_matrix, df_ri = _write_matrix_section(f, df)
+                    toc.append( toc_matrix )
+                    if (compressed):
+                        source = ('stream', path, ',', None)
+                    if ('###TSDataRowIndex' in sections):
+                        toc.append( _write_section(f, '###TSDataRowIndex', df_ri.to_csv(encoding="utf-8")) )
+                        source = ('text', path, toc_matrix[1], toc_matrix[2], ',', toc[-1][1:], None)
+                if (not compressed):
+                    f.seek(toc_offset)
+                    f.write( _format_toc(toc) )
+                f.close()
+        except:
+            if (os.path.exists(path_tmp)):
+                os.remove(path_tmp)
+            raise
+        os.rename(path_tmp, path)
+        # remove stale sidecar
+        if ((not self.binary or df.empty) and os.path.exists(binpath)):
+            os.remove(binpath)
+        # matrix dropped by cache is read from the saved file from now on
+        # (or kept resident, if it cannot be read back from it)
+        if (self._df_cache is not None):
+            if (source is None):
+                self._df_cache.discard(self)
+                self._df_cache = None
+            self._df_source = source
+            self._df_deltas = []
+            self._df_columns = None
+        self._saved_samples = self.df_meta.columns.tolist()
+        self._saved_version = self.metadata['version']
+        self._genes_loaded = None
+        return True
+
+    # @description save only newly added samples (ex: by appendsample)
+    # by appending delta sections to the end of current file.
+    # (changes except new samples - metadata, removed samples - need save())
+    # falls back to save() if file is not written yet, or file is older format(v0.1).
+    # raise Exception if matrix is partially loaded (load() with genes),
+    # as appended samples would miss other genes.
+    def save_append(self, path=None):
+        if (path == None):
+            path = self.cur_path
+        if (path != self.cur_path or self._saved_samples is None or not os.path.exists(path)
+                or self._saved_version < 0.2
+                or not set(self._saved_samples) <= set(self.df_meta.columns)):
+            return self.save(path)
+        if (self._genes_loaded is not None):
+            raise Exception('Cannot append samples to partially loaded matrix (genes); use save()')
+        saved = set(self._saved_samples)
+        cols_new = [c for c in self.df_meta.columns if c not in saved]
+        if (len(cols_new) == 0):
+            return True
+        df = self.df
+        cols_mat = [c for c in cols_new if c in df.columns]
+        with _open_tsd(path, "ab") as f:
+            _write_section(f, '###TSDataDeltaHeader', self.df_meta[cols_new].to_csv(encoding="utf-8"))
+            if (len(cols_mat) > 0):
+                _write_section(f, '###TSDataDeltaMatrix', df[cols_mat].to_csv(encoding="utf-8"))
             f.close()
+        self._saved_samples = self.df_meta.columns.tolist()
         return True
 
-    def readmatrix(self, fix_genename=True):
+    # @description fold delta sections into main sections (rewrites file)
+    # (not allowed for partially loaded matrix, see save())
+    def compact(self, path=None):
+        return self.save(path)
+
+    # cache: GeneMatrixCache of parsed matrix files (None: not used)
+    def readmatrix(self, fix_genename=True, workers=None, cache=None):
         df_g = GeneMatrix()
 
         # TODO: before reading, preprocess & read matrix files ...?
+        fps = []
         for c in self.df_meta.columns:
             fp = self.df_meta[c]['Filepath']
             if (fp == None or pd.isnull(fp)):
                 print '[WARNING] %s filepath is NaN. Canceled.' % c
                 return
-            df_g.load_from_path(fp)
+            fps.append(fp)
+        df_g = df_g.load_from_paths(fps, dtype=self.dtype, workers=workers, cache=cache)
         self.df = df_g[self.df_meta.columns]
 
     def readmatrix_from_matrix(self, df_mat):
@@ -536,10 +1766,14 @@ class TSData(object):
 
     # @descript filter logic to df / df_meta dataframe.
     def filter_by_logic(self, logic):
-        self.filter(self.df.columns[logic])
+        self.filter(self.df_meta.columns[logic])
     # @descript filter by SampleID s.
     def filter(self, names):
-        self.df = self.df[names]
+        if (not self.IsMatrixLoaded()):
+            # lazy matrix: select columns when it's read
+            self._df_columns = list(names)
+        elif (not self.df.empty):
+            self.df = self.df[names]
         self.df_meta = self.df_meta[names]
 
     # @description get CIDs
@@ -555,18 +1789,12 @@ class TSData(object):
     def IsTSExists(self, tsname):
         return tsname in self.conditions
     # returns timepoint, replicates
+    # (timepoints are ordered by time)
     def GetTSTimepoint(self, tsname):
-        arr_bool = list(self.df_meta.loc['SeriesID',:] == tsname)
-        df_extracted = self.df_meta.loc[:,arr_bool]
-        timepoints = []
-        replicates = {}
-        for i in list(df_extracted.loc['Time',:]):
-            if i not in timepoints:
-                timepoints.append(i)
-                replicates[i] = 0
-            replicates[i] += 1
-        replicates_arr = map(lambda x: replicates[x], timepoints)
-        return (timepoints, replicates_arr)
+        g = self.getSeriesGroups()
+        if (tsname not in g.timepoints):
+            return ([], [])
+        return (list(g.timepoints[tsname]), list(g.replicates[tsname]))
     # get all TS description(including timepoints/replicates)
     # returns: [ { dict, id, timepoints:[], replicates:[] } ]
     def GetAllTSDescription(self):
@@ -582,13 +1810,86 @@ class TSData(object):
     # get Gene expression profile for time using specific gene markers
     # (expression value is averaged, x pos calculated with: (index)/(colsize) )
     # returns: [ (x:0~1 float, y:avg. gene expr.) ]
-    def GetProfile(self, gnames):
-        r = []
-        df_extracted = self.df.loc[gnames,:]
-        df_mean = df_extracted.mean(axis=0)
-        y = list(df_mean)
-        x = [float(i)/len(y) for i in range(len(y))]
-        return zip(x,y)
+    #   (x is (SeriesID, time in hours) with x='time', see GetProfiles())
+    def GetProfile(self, gnames, x='index'):
+        df_prof = self.GetProfiles([gnames,], x)
+        return zip(df_prof.columns.tolist(), df_prof.iloc[0].tolist())
+
+    # get Gene expression profiles of many gene sets at once
+    # (sparse gene set x gene indicator matrix is multiplied with expression matrix
+    #  if scipy is available; otherwise rows of each gene set are gathered and summed)
+    # genes not in matrix and NaN values are ignored when averaging.
+    # @argument genesets: dict (name -> [genenames]) or list of [genenames]
+    # @argument x: 'index' - x pos calculated with: (index)/(colsize)
+    #   'time' - replicates are averaged, x pos is (SeriesID, time in hours) of each group
+    # returns: DataFrame (index: gene set names, columns: x pos,
+    #   MultiIndex of SeriesID / Time in case of 'time')
+    def GetProfiles(self, genesets, x='index'):
+        if (isinstance(genesets, dict)):
+            names = list(genesets.keys())
+            genesets = [genesets[k] for k in names]
+        else:
+            genesets = list(genesets)
+            names = range(len(genesets))
+        df = self.df
+        # gene set x gene indicator (row: gene set, col: row position of gene)
+        set_ids = np.repeat(np.arange(len(genesets)), [len(gs) for gs in genesets])
+        genes = np.array([g for gs in genesets for g in gs], dtype=object)
+        if (df.index.is_unique):
+            pos = df.index.get_indexer(genes)
+        else:
+            df_pos = pd.DataFrame({'g': genes, 's': set_ids}).merge(
+                    pd.DataFrame({'g': df.index, 'p': np.arange(len(df.index))}), on='g', how='left')
+            set_ids = df_pos['s'].values
+            pos = df_pos['p'].fillna(-1).values.astype(np.int64)
+        found = pos >= 0
+        set_ids, pos = set_ids[found], pos[found]
+        if (sparse is not None):
+            ind = sparse.csr_matrix((np.ones(len(pos)), (set_ids, pos)),
+                    shape=(len(genesets), len(df.index)))
+            sum_sets = lambda X: np.asarray(ind.dot(X))
+        else:
+            order = np.argsort(set_ids, kind='mergesort')
+            set_ids, pos = set_ids[order], pos[order]
+            starts = np.flatnonzero(np.r_[True, set_ids[1:] != set_ids[:-1]]) if len(pos) > 0 else []
+            def sum_sets(X):
+                r = np.zeros((len(genesets), X.shape[1]))
+                if (len(pos) > 0):
+                    r[set_ids[starts]] = np.add.reduceat(X[pos], starts, axis=0)
+                return r
+
+        # averaged expression (NaN values are excluded from sum and count)
+        mat = df.values.astype(np.float64)
+        isnum = ~np.isnan(mat)
+        if (isnum.all()):
+            sums = sum_sets(mat)
+            cnts = np.bincount(set_ids, minlength=len(genesets)).astype(np.float64).reshape(-1, 1)
+        else:
+            sums = sum_sets(np.where(isnum, mat, 0))
+            cnts = sum_sets(isnum.astype(np.float64))
+
+        if (x == 'time'):
+            # average replicates of each (SeriesID, Time)
+            g = self.getSeriesGroups()
+            cols = df.columns.get_indexer(self.df_meta.columns[g.cols])
+            if ((cols < 0).any()):
+                raise Exception('Matrix does not have some samples of df_meta')
+            cnts = np.broadcast_to(cnts, sums.shape)
+            if (len(g.keys) > 0):
+                sums = np.add.reduceat(sums[:, cols], g.starts, axis=1)
+                cnts = np.add.reduceat(cnts[:, cols], g.starts, axis=1)
+            else:
+                sums = cnts = np.empty((len(genesets), 0))
+            # (same timepoint of different series is kept apart)
+            xpos = pd.MultiIndex.from_arrays([[k[0] for k in g.keys], g.hours],
+                    names=['SeriesID', 'Time'])
+        elif (x == 'index'):
+            xpos = [float(i)/sums.shape[1] for i in range(sums.shape[1])]
+        else:
+            raise Exception('%s: NotSupported' % x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prof = sums / cnts
+        return pd.DataFrame(prof, index=names, columns=xpos)
 
     # -------------------------
     # modifiers
@@ -596,47 +1897,71 @@ class TSData(object):
 
     # @description flatten replicated TS column into single one
     # (in case of replication is unsupported, ex: wigwams)
-    # @argument func: first / avg(default) / max / min
-    def flatten_replication(self, func='avg'):
-        def removeduplicated(a):
-            r = []
-            for e in a:
-                if (e not in r):
-                    r.append(e)
-            return r
+    # all groups are reduced at once, using replicate-group index.
+    # columns are ordered by series / time in order of appearance,
+    # and named as 'SeriesID_Time'. (NaN values are ignored, except for 'first')
+    # @argument func: first / avg(default) / median / max / min / weighted
+    # @argument weights: weight of each sample (for 'weighted')
+    #   dict/Series (SampleID -> weight), or name of df_meta row (ex: 'Weight')
+    def flatten_replication(self, func='avg', weights=None):
+        g = self.getSeriesGroups()
         df = self.df
         dfh = self.df_meta
-        # newly generating data
-        n_dfh = pd.DataFrame(index=['CID','Time'])
-        n_dfh.index.name = 'SampleID'
-        n_df = pd.DataFrame(index=df.index)
-        # filter from CID and Time
-        CID_set = removeduplicated(dfh.loc['CID'])  # to be in order
-        i=0
-        n_df_cols = []
-        for CID in list(CID_set):
-            arr_bool = dfh.loc['CID'] == CID
-            dfh_cond = dfh.loc[:, list(arr_bool)]
-            df_cond = df.loc[:, list(arr_bool)]
-            time_set = removeduplicated(dfh_cond.loc['Time'])
-            for t in list(time_set):
-                # set data column name automatically, using time & CID
-                col_name = '%s_%s' % (CID, t)
-                df_cond_time = df_cond.loc[:,list(dfh_cond.loc['Time']==t)]
-                if (func == 'avg'):
-                    n_df[col_name] = df_cond_time.mean(axis=1)
-                elif (func == 'first'):
-                    raise Exception('First: NotImplemented')
-                elif (func == 'max'):
-                    raise Exception('Max: NotImplemented')
-                elif (func == 'min'):
-                    raise Exception('Min: NotImplemented')
-                else:
-                    raise Exception('%s: NotSupported' % func)
-                n_df_cols.append(col_name)
-                n_dfh[col_name] = [CID, t]
+        sample_ids = dfh.columns[g.cols]
+        if (df.empty):
+            X = np.empty((len(df.index), len(g.cols)))
+        else:
+            X = df.values[:, df.columns.get_indexer(sample_ids)]
+        starts = g.starts
+        counts = g.counts
+
+        if (len(g.keys) == 0):
+            mat = np.empty((X.shape[0], 0))
+        elif (func == 'first'):
+            mat = X[:, starts]
+        elif (func == 'max'):
+            mat = np.fmax.reduceat(X, starts, axis=1)
+        elif (func == 'min'):
+            mat = np.fmin.reduceat(X, starts, axis=1)
+        elif (func == 'median'):
+            # pad groups into (genes, groups, max replication) array
+            pad = np.full((X.shape[0], len(g.keys), counts.max()), np.nan)
+            pad[:, np.repeat(np.arange(len(g.keys)), counts),
+                    np.arange(len(g.cols)) - np.repeat(starts, counts)] = X
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                mat = np.nanmedian(pad, axis=2)
+        elif (func == 'avg' or func == 'weighted'):
+            if (func == 'avg'):
+                w = np.ones(len(g.cols))
+            elif (weights is None):
+                raise Exception('weights are required for weighted flatten')
+            elif (isinstance(weights, basestring)):
+                w = dfh.loc[weights].values[g.cols].astype(float)
+            else:
+                w = pd.Series(weights).reindex(sample_ids).values.astype(float)
+                if (np.isnan(w).any()):
+                    raise Exception('weight is not given for some samples')
+            isnum = ~np.isnan(X)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mat = np.add.reduceat(np.where(isnum, X, 0) * w, starts, axis=1, dtype=np.float64) \
+                        / np.add.reduceat(isnum * w, starts, axis=1)
+        else:
+            raise Exception('%s: NotSupported' % func)
+        # (accumulated in float64, then returned in float dtype of matrix)
+        if (X.dtype.kind == 'f'):
+            mat = mat.astype(X.dtype, copy=False)
+
+        # order of columns: series / time in order of appearance
+        series_rank = dict([(sid, i) for i,sid in enumerate(g.series)])
+        order = np.lexsort((g.cols[starts], [series_rank[k[0]] for k in g.keys])) \
+                if len(g.keys) > 0 else np.array([], dtype=int)
+        cols = [g.labels[i] for i in order]
         # use result
-        self.df = n_df
+        n_dfh = pd.DataFrame([[g.keys[i][0] for i in order], [g.keys[i][1] for i in order]],
+                index=['SeriesID','Time'], columns=cols)
+        n_dfh.index.name = 'SampleID'
+        self.df = pd.DataFrame(mat[:, order], index=df.index, columns=cols)
         self.df_meta = n_dfh
 
     def rescale_replication(self):
@@ -648,24 +1973,27 @@ class TSData(object):
     # raise Exception if inavailable format.
     #
     def convert_timedata_float(self):
-        arr_t = self.df_meta.loc['Time'].tolist()
-        arr_t = map(lambda x: GetTSFromString(x), arr_t)
-        self.df_meta.loc['Time'] = arr_t
+        arr_t = self.df_meta.loc['Time']
+        hours = self.getTimeHours()
+        invalid = np.isnan(hours) & arr_t.notnull().values
+        if (invalid.any()):
+            raise Exception("Cannot extract time info from string: %s" % arr_t[invalid].iloc[0])
+        self.df_meta.loc['Time'] = hours
+        self._invalidate_groups()
+        self._time_hours = hours
 
     # @description split this timeseries from CID
     # in case of program requires each condition as separated file (ex: EDISA)
     def SplitByCID(self):
         r = []
         df = self.df
-        dfh = self.df_meta
-        CID_set = removeduplicated(dfh.loc['CID'])  # to be in order
-        # newly generating data
-        for CID in list(CID_set):
-            arr_bool = dfh.loc['CID'] == CID
-            dfh_cond = dfh.loc[:, arr_bool]
-            df_cond = df.loc[:, arr_bool]
+        g = self.getSeriesGroups()
+        # newly generating data (series in order)
+        for CID in g.series:
+            dfh_cond = self.df_meta.iloc[:, g.series_cols[CID]]
             tsdat = TSData()
-            tsdat.df = df_cond
+            if (not df.empty):
+                tsdat.df = df[dfh_cond.columns]
             tsdat.df_meta = dfh_cond
             tsdat.metadata['dfpath'] = None
             r.append(tsdat)
@@ -753,9 +2081,7 @@ class TSData(object):
 
         # if timeseries information is null, then fill it
         if arr_TS_time == None:
-            arr_TS_time = []
-            for col in arr_TS_col:
-                arr_TS_time.append(GetTSFromString(col))
+            arr_TS_time = ParseTimeArray(arr_TS_col).tolist()
         elif (type(arr_TS_time) is list):
             if (len(arr_TS_time) == 1):
                 print('[WARNING] timeseries data doesnt fit with origin file dimension (%s)', str(self.metadata['name']))
@@ -802,34 +2128,74 @@ class TSData(object):
 #
 
 # @description Merge TS objects and creates new one
-def merge(arr_ts):
+# gene index is built once, and merged matrix is allocated at once
+# (each series is copied into its column block by row position).
+# @argument how: 'outer' (union of genes, missing value is NaN)
+#   / 'inner' (intersection of genes) / 'exact' (gene index should be same)
+#   duplicated genes are kept as they are in 'exact', and only the first
+#   row of each duplicated gene is used in 'outer' / 'inner'.
+# @argument dtype: dtype of merged matrix (None: common dtype of matrices)
+def merge(arr_ts, how='outer', dtype=None):
+    arr_ts = list(arr_ts)
     if (len(arr_ts) == 0):
         raise Exception("merging TS is zero; give valid TS set.")
 
     ts_r = TSData()
-
-    # check validation
-    arr_idx = None
-    for ts in arr_ts:
-        if arr_idx is None:
-            arr_idx = list(ts.df.index)
-        else:
-            if (arr_idx != list(ts.df.index)):
+    arr_df = [ts.df for ts in arr_ts]
+    # (series with samples but no genes takes part in gene index, too)
+    arr_idx = [df.index for df in arr_df if len(df.columns) > 0]
+
+    # build gene index
+    if (len(arr_idx) == 0):
+        index = pd.Index([])
+    elif (how == 'exact'):
+        index = arr_idx[0]
+        for idx in arr_idx[1:]:
+            if (not index.equals(idx)):
                 raise Exception('Cannot merge series, as Genename index is different.')
+    elif (how == 'outer'):
+        index = pd.Index(np.concatenate([idx.values for idx in arr_idx])).unique()
+    elif (how == 'inner'):
+        cnt = pd.Index(np.concatenate([idx.unique().values for idx in arr_idx])).value_counts()
+        index = arr_idx[0].unique()
+        index = index[index.isin(cnt.index[cnt.values == len(arr_idx)])]
+    else:
+        raise Exception('%s: NotSupported' % how)
+    index.name = arr_idx[0].name if len(arr_idx) > 0 else None
+
+    # allocate matrix (column-major, so each series fills contiguous block)
+    if (dtype is None):
+        dtypes = [dt for df in arr_df for dt in df.dtypes]
+        dtype = np.result_type(*dtypes) if len(dtypes) > 0 else np.float64
+    dtype = np.dtype(dtype)
+    if (how == 'outer' and dtype.kind != 'f'):
+        dtype = np.dtype(np.float64)
+    columns = [c for df in arr_df for c in df.columns]
+    if (how == 'outer'):
+        mat = np.full((len(index), len(columns)), np.nan, dtype=dtype, order='F')
+    else:
+        mat = np.empty((len(index), len(columns)), dtype=dtype, order='F')
+    c = 0
+    for df in arr_df:
+        n = len(df.columns)
+        if (df.empty):
+            pass
+        elif (how == 'exact'):
+            mat[:, c:c+n] = df.values
+        else:
+            pos = index.get_indexer(df.index)
+            b = (pos >= 0) & ~df.index.duplicated(keep='first')
+            mat[pos[b], c:c+n] = df.values[b]
+        c += n
 
-    # sum'em all
-    for ts in arr_ts:
-        ts_r.conditions.update(ts.conditions)
-    arr_df = map(lambda x: x.df, arr_ts)
-    arr_df_meta = map(lambda x: x.df_meta, arr_ts)
-    ts_r.df = pd.concat(arr_df, axis=1)
-    ts_r.df_meta = pd.concat(arr_df_meta, axis=1)
+    ts_r.df = pd.DataFrame(mat, index=index, columns=columns)
+    ts_r.df_meta = pd.concat([ts.df_meta for ts in arr_ts], axis=1)
 
     return ts_r
 
-def load(fpath):
+def load(fpath, lazy=False, genes=None, dtype=None):
     tsd = TSData()
-    tsd.load(fpath)
+    tsd.load(fpath, lazy, genes, dtype)
     return tsd
 
 
@@ -840,7 +2206,7 @@ if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Process TSData.')
     parser.add_argument('command', type=str, default='open',
-            help='open / fix')
+            help='open / fix / tobinary / totext')
     parser.add_argument('file', type=str, help='file for command')
     args = parser.parse_args()
     if (args.command == 'open'):
@@ -851,5 +2217,13 @@ if __name__=="__main__":
         print 'fixing time order / name / etc ...'
         tsd.fix()
         tsd.save()
+    elif (args.command == 'tobinary'):
+        tsd = load(args.file)
+        print 'converting matrix into binary sidecar (%s) ...' % GetBinaryPath(args.file)
+        tsd.save(binary=True)
+    elif (args.command == 'totext'):
+        tsd = load(args.file)
+        print 'converting matrix into text section ...'
+        tsd.save(binary=False)
     else:
         parser.print_help()
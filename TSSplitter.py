@@ -6,14 +6,90 @@ import pandas as pd
 import numpy as np
 import TSData
 import os
+import bisect
+
+# upper-cased name (for case-insensitive matching)
+def _upper(name):
+    if (not isinstance(name, basestring)):
+        name = str(name)
+    return name.upper()
+
+# (internal function)
+# read matrix file in row chunks, into matrix allocated at once
+# (lines are counted first, so chunks are not kept until concatenated)
+def _read_matrix_chunks(path, sep, usecols, chunksize):
+    with open(path, 'rb') as f:
+        nrows = sum([b.count('\n') for b in iter(lambda: f.read(1 << 20), '')])
+    mat = None
+    index = []
+    n = 0
+    for chunk in pd.read_csv(path, header=0, index_col=0, sep=sep, usecols=usecols, chunksize=chunksize):
+        v = chunk.values
+        if (mat is None):
+            columns = chunk.columns
+            mat = np.empty((nrows, len(columns)), dtype=v.dtype)
+        elif (not np.can_cast(v.dtype, mat.dtype)):
+            mat = mat.astype(np.result_type(mat.dtype, v.dtype))
+        mat[n:n+len(v)] = v
+        index.append(chunk.index)
+        n += len(v)
+    if (mat is None):
+        return pd.read_csv(path, header=0, index_col=0, sep=sep, usecols=usecols)
+    return pd.DataFrame(mat[:n], index=index[0].append(index[1:]), columns=columns)
 
 class TSSplitter:
     def __init__(self):
         self.df = pd.DataFrame()
         self.groups = {}
+        self.columns_all = []   # all sample columns of matrix file
+        self._prefix_index = None
+
+    # @description load matrix file
+    # only columns of samples in loaded groups are read (LoadGroup_csv / LoadSample_csv
+    # should be called first), so memory is proportional to extracted data.
+    # (column is read if it starts with SampleID, case-insensitive; see Extract())
+    # if no sample is loaded yet, all columns are read.
+    # @argument project: read only required columns (False: read all columns)
+    # @argument chunksize: read matrix in row chunks of this size (None: at once)
+    #   chunks are copied into a single matrix, so values have common dtype.
+    def LoadMatrix(self, path, sep="\t", project=True, chunksize=None):
+        self.columns_all = pd.read_csv(path, header=0, index_col=0, sep=sep, nrows=0).columns.tolist()
+        usecols = None
+        targets = set()
+        for group in self.groups.values():
+            targets.update([str(x[0]).upper() for x in group['geneinfo']])
+        if (project and len(targets) > 0):
+            targets = tuple(targets)
+            usecols = [0,] + [i+1 for i,c in enumerate(self.columns_all)
+                    if c.upper().startswith(targets)]
+        if (chunksize is not None):
+            df = _read_matrix_chunks(path, sep, usecols, chunksize)
+        else:
+            df = pd.read_csv(path, header=0, index_col=0, sep=sep, usecols=usecols)
+        self.df = df
+        self._get_prefix_index()
+
+    # (internal function)
+    # prefix index of matrix columns, built once for loaded matrix
+    # returns: (columns, sorted upper-cased column names, column position of each)
+    def _get_prefix_index(self):
+        if (self._prefix_index is None or self._prefix_index[0] is not self.df.columns):
+            names = [_upper(c) for c in self.df.columns]
+            order = sorted(range(len(names)), key=names.__getitem__)
+            self._prefix_index = (self.df.columns, [names[i] for i in order], order)
+        return self._prefix_index
 
-    def LoadMatrix(self, path, sep="\t"):
-        self.df = pd.read_csv(path,header=0,index_col=0,sep=sep)
+    # (internal function)
+    # column positions which starts with prefix (case-insensitive)
+    def _match_prefix(self, prefix):
+        columns, names, order = self._get_prefix_index()
+        prefix = _upper(prefix)
+        r = []
+        i = bisect.bisect_left(names, prefix)
+        while (i < len(names) and names[i].startswith(prefix)):
+            r.append(order[i])
+            i += 1
+        return r
 
     # requires in row:
     # csv column:  CID, Species, Stress, Tissue, Genotype
@@ -66,40 +142,33 @@ class TSSplitter:
     # @description for depreciated LoadGroup method.
     # csv column requires: CID, GeneID, Time, (optional)Valid
     # (don't use replication count/index data)
+    # samples are grouped with single pass, and sorted with time(numeric)/index.
     def LoadSample_csv(self, path):
-        def gene_sorter(e):
-            ts = str(e[1])
-            t_ = (12-len(ts))*'0' + ts
-            return t_ + '_' + str(e[2])
-
         csv_df = pd.read_csv(path, index_col=False, header=0) # 1: SampleID, 3: CID
-        CIDs = list(set(csv_df.ix[:,'CID'].tolist()))
-        for CID in CIDs:
+        # used for sorting index (for replication-order consistency)
+        csv_df['_idx'] = csv_df.groupby('CID').cumcount()
+        csv_df['Time'] = csv_df['Time'].fillna(0)
+        for k in ['Title', 'Detail']:
+            if (k not in csv_df.columns):
+                csv_df[k] = ''
+            csv_df[k] = csv_df[k].fillna('')
+        if ('Valid' in csv_df.columns):
+            csv_df['_valid'] = csv_df['Valid'].fillna(0) != 0
+        else:
+            csv_df['_valid'] = True
+        # sort with time/rep
+        hours = TSData.ParseTimeArray(csv_df['Time'].values, errors='coerce')
+        csv_df = csv_df.iloc[np.lexsort((csv_df['_idx'].values,
+            csv_df['Time'].astype(str).values, hours))]
+        for CID, csv_cond in csv_df.groupby('CID', sort=False):
             if (CID not in self.groups):
                 print '%s CID not exists, ignore.' % CID
                 continue
-            group = self.groups[CID]
-            b_CID = csv_df.ix[:,'CID'] == CID
-            csv_cond = csv_df[b_CID]
-            genelist = csv_cond.ix[:,'SampleID'].tolist()
-            #rep = csv_cond.ix[:,5].fillna(0).tolist()   # fill NA for use
-            idx = range(len(genelist))  # used for sorting index (for replication-order consistency)
-            time = csv_cond.ix[:,'Time'].fillna(0).tolist()
-            if ('Title' not in csv_cond.columns):
-                csv_cond['Title'] = np.nan
-            if ('Detail' not in csv_cond.columns):
-                csv_cond['Detail'] = np.nan
-            title = csv_cond.ix[:,'Title'].fillna('').tolist()
-            detail = csv_cond.ix[:,'Detail'].fillna('').tolist()
-            if ('Valid' in csv_cond.columns):
-                valid_list = list(csv_cond.ix[:,'Valid'].fillna(0) != 0)
-            else:
-                valid_list = [True] * len(genelist)
-            # sort with rep/time
-            geneinfo = zip(genelist, time, idx, valid_list, title, detail)
-            geneinfo = filter(lambda x: x[3], geneinfo) # filter invalid genes
-            geneinfo.sort(key=gene_sorter)
-            group['geneinfo'] = geneinfo
+            csv_cond = csv_cond[csv_cond['_valid'].values]  # filter invalid genes
+            self.groups[CID]['geneinfo'] = zip(
+                    csv_cond['SampleID'].tolist(), csv_cond['Time'].tolist(),
+                    csv_cond['_idx'].tolist(), csv_cond['_valid'].tolist(),
+                    csv_cond['Title'].tolist(), csv_cond['Detail'].tolist())
 
     # @description
     # Extract microarray file from big-microarray file using TS metadata.
@@ -124,31 +193,33 @@ class TSSplitter:
         if (exactname):
             df_out = self.df[tsd.df_meta.columns]
         else:
-            # extract valid column name
-            col_valid_gn = []
-            col_valid_b = []
-            col_target = [s.upper() for s in list(tsd.df_meta.columns)]
-            col_available = self.df.columns
-            for col in col_available:
-                col_up = col.upper()
-                col_res = False
-                for col_comp in col_target:
-                    if (col_up.startswith(col_comp)):
-                        col_valid_gn.append(col_up)
-                        col_res = True
-                        break
-                col_valid_b.append(col_res)
-            if (len(col_valid_gn) < len(col_target)):
+            # find matching column of each sample, using prefix index.
+            # exact / extension-only match (ex: GSM1, GSM1_A.CEL) is preferred
+            # to bare prefix match (ex: GSM10.CEL), and column is assigned
+            # to the longest sample prefix it starts with.
+            samples = [_upper(s) for s in tsd.df_meta.columns]
+            col_owner = {}
+            for i, s in enumerate(samples):
+                cols = self._match_prefix(s)
+                cols_ext = [c for c in cols if not _upper(self.df.columns[c])[len(s):len(s)+1].isalnum()]
+                for c in (cols_ext or cols):
+                    if (c not in col_owner or len(samples[col_owner[c]]) < len(s)):
+                        col_owner[c] = i
+            col_matches = [[] for s in samples]
+            for c, i in sorted(col_owner.items()):
+                col_matches[i].append(c)
+            col_pos = [m[0] for m in col_matches if len(m) > 0]
+            if (len(col_pos) < len(col_matches)):
                 print("Not all columns included in matrix file")
                 return False
-            elif (len(col_valid_gn) > len(col_target)):
+            elif (max([len(m) for m in col_matches]) > 1):
                 print("Too many columns selected; maybe invalid filter")
                 return False
-            print col_valid_gn
-            # extract dataframe
-            df_out = self.df.loc[:,col_valid_b]
+            print [_upper(self.df.columns[i]) for i in col_pos]
+            # extract dataframe (in order of samples)
+            df_out = self.df.iloc[:,col_pos]
         # reset(fit) column name
-        tsd.df.index.name = 'Genename'
+        df_out.index.name = 'Genename'
         df_out.columns = tsd.df_meta.columns
 
         # in case of includedf
@@ -156,6 +227,9 @@ class TSSplitter:
             tsd.df = df_out
             #tsd.save()
         else:
+            TSpath = tsd.cur_path
+            if (TSpath is None):
+                raise Exception("TSData path is required to save extracted matrix")
             fn = os.path.basename(TSpath)
             df_out.to_csv(
                 os.path.dirname(TSpath) + "/" + os.path.splitext(fn)[0] + '.txt',
@@ -163,41 +237,90 @@ class TSSplitter:
                 )
         return True
 
+    # (internal function)
+    # make TSData (without matrix) of group
+    def _make_tsdata(self, CID, group):
+        rows = []
+        rep_cnt = {}
+        for sampleid,time,idx,valid,title,detail in group['geneinfo']:
+            # replication: order of sample in same timepoint
+            rep_cnt[time] = rep_cnt.get(time, -1) + 1
+            rows.append({
+                'SeriesID': CID, 'Time': time, 'Replication': rep_cnt[time],
+                'Desc': title, 'Stressdetail': detail,
+                'Species': group['Species'], 'Stress': group['Stress'],
+                'Tissue': group['Tissue'], 'Genotype': group['Genotype'],
+                'Ecotype': group['Ecotype'], 'Age': group['Age'],
+                'Filetype': group['Type'],
+                })
+        df_meta = pd.DataFrame(rows, index=[x[0] for x in group['geneinfo']]).transpose()
+        # make TSData
+        tsdat = TSData.TSData()
+        tsdat.appendsample(df_meta)
+        tsdat.metadata['name'] = CID
+        tsdat.metadata['date'] = group['Date']
+        tsdat.metadata['source'] = group['Source']
+        tsdat.metadata['type'] = group['Type']
+        tsdat.metadata['desc'] = group['Desc']
+        return tsdat
+
     # creates multiple csv file
     # @argument
     # include: include microarray data into TS file. if not, generate separate microarray file
-    def ExtractAll(self, outdir="./", included=False):
+    # workers: extract & save each CID with process pool
+    #   (matrix is shared with workers as memory-mapped binary file)
+    # returns: dict (CID -> {'path': saved path or None, 'error': error message or None})
+    def ExtractAll(self, outdir="./", included=False, workers=None):
+        tasks = []
         for CID,group in self.groups.items():
-            # generate df_meta
-            genenames = map(lambda x: x[0], group['geneinfo'])
-            if (len(genenames) == 0):
+            if (len(group['geneinfo']) == 0):
                 print "%s CID has no genes, ignored" % CID
                 continue
-            df_meta = pd.DataFrame(index=['CID','Time','Title','Detail'],columns=genenames)
-            df_meta.index.name = 'SampleID'
-            for sampleid,time,rep,valid,title,detail in group['geneinfo']:
-                df_meta[sampleid] = [CID, time, title, detail]
-            # make TSData
-            tsdat = TSData.TSData()
-            tsdat.df_meta = df_meta
-            tsdat.metadata['name'] = CID
-            tsdat.metadata['date'] = group['Date']
-            tsdat.metadata['source'] = group['Source']
-            tsdat.metadata['type'] = group['Type']
-            tsdat.metadata['desc'] = group['Desc']
-            # make TSCondition
-            cond = tsdat.getCondition(CID)
-            cond.SetStress(group['Stress'])
-            cond.age = group['Age']
-            cond.species = group['Species']
-            cond.tissue = group['Tissue']
-            cond.datatype = group['Type']
-            cond.genotype = group['Genotype']
-            cond.ecotype = group['Ecotype']
-            # extract df
-            print 'Extracting %s' % CID
-            if (self.Extract(tsdat, True)):
-                print(str(tsdat))
-                tsdat.save(os.path.join(outdir,"%s.tsd"%CID))
+            tasks.append((CID, group, outdir))
+        results = {}
+        # (matrix which cannot be shared as binary file is extracted serially)
+        if (workers is None or workers <= 1 or not TSData.IsBinaryMatrix(self.df)):
+            for task in tasks:
+                CID, r = _extract_task(self, task)
+                results[CID] = r
+            return results
+        # matrix is shared in memory(tmpfs) if available
+        with TSData.WorkerPool(workers, 'TSSplitter') as (pool, shm_dir):
+            bin_path = os.path.join(shm_dir, 'matrix.bin')
+            TSData.save_matrix_binary(bin_path, self.df)
+            args = [(bin_path, task) for task in tasks]
+            for CID, r in pool.imap_unordered(_extract_worker, args):
+                results[CID] = r
+        return results
 
+# (internal function)
+# extract & save TSData of a CID
+# returns: (CID, {'path': saved path or None, 'error': error message or None})
+def _extract_task(sp, task):
+    CID, group, outdir = task
+    try:
+        tsdat = sp._make_tsdata(CID, group)
+        # extract df
+        print 'Extracting %s' % CID
+        if (not sp.Extract(tsdat, True)):
+            return (CID, {'path': None, 'error': 'Samples are not matched with matrix columns'})
+        print(str(tsdat))
+        path = os.path.join(outdir,"%s.tsd"%CID)
+        tsdat.save(path)
+        return (CID, {'path': path, 'error': None})
+    except Exception as e:
+        return (CID, {'path': None, 'error': str(e)})
 
+# (internal function)
+# process pool worker of TSSplitter.ExtractAll()
+# each worker maps shared matrix once (at its first task).
+_worker_splitter = (None, None)     # (path of shared matrix, TSSplitter)
+def _extract_worker(args):
+    global _worker_splitter
+    bin_path, task = args
+    if (_worker_splitter[0] != bin_path):
+        sp = TSSplitter()
+        sp.df = TSData.load_matrix_binary(bin_path, mmap=True)
+        sp._get_prefix_index()
+        _worker_splitter = (bin_path, sp)
+    return _extract_task(_worker_splitter[1], task)
@@ -3,6 +3,10 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import os
+import json
+import tempfile
+import multiprocessing
+import time
 
 def activateR():
     global r
@@ -22,7 +26,10 @@ def activateR():
 
 # convert to TSD files
 # without including microarray data
-def ConvertCSVtoTSDs(fp, dest_dir='', save=True):
+# (sample sheet is grouped with single pass, samples are ordered by numeric time)
+# workers: save TSD files with process pool
+# returns: list of TSData
+def ConvertCSVtoTSDs(fp, dest_dir='', save=True, workers=None):
     df_csv = pd.read_csv(fp,encoding='utf-8')
     tsds = []
 
@@ -36,12 +43,19 @@ def ConvertCSVtoTSDs(fp, dest_dir='', save=True):
         if  k not in df_csv:
             df_csv[k] = np.nan
 
-    for (name, df) in df_csv.groupby('SeriesID'):
+    # sort samples with time (in hours), then order in sheet
+    hours = TSData.ParseTimeArray(df_csv['Time'].values, errors='coerce')
+    df_csv = df_csv.iloc[np.lexsort((np.arange(len(df_csv)), hours))]
+    # (aligned with rows of TSData.df_meta once, as appendsample() does)
+    df_meta_all = df_csv[keys_to_record].set_index('SampleID').transpose()
+    df_meta_all = df_meta_all.reindex(TSData.TSData().df_meta.index)
+
+    for (name, pos) in sorted(df_csv.groupby('SeriesID').indices.items()):
         # Name / h / stress / species / tissue / genotype / ecotype / filename / filetype
         # parse json metadata first
         dat = {}
         for k in {'SeriesID','Date','Desc'}:
-            dat[k.lower()] = df.iloc[0][k]
+            dat[k.lower()] = df_csv[k].iat[pos[0]]
         # VALIDATION CHECK: no comma allowed
         if (',' in dat['seriesid']):
             raise Exception("Comma in name isn't allowed!")
@@ -49,31 +63,99 @@ def ConvertCSVtoTSDs(fp, dest_dir='', save=True):
         # parse series metadata frame
         tsd = TSData.TSData()
         tsd.metadata.set(dat)
-        df_new = df[keys_to_record].set_index('SampleID').transpose()
-        tsd.appendsample(df_new)
-        #print df_new
-        print tsd.df_meta
+        tsd.df_meta = df_meta_all.iloc[:, pos]
         tsds.append(tsd)
-        # save TSData (without metadata)
-        if (save):
-            tsd.save(dest_dir+name+'.tsd')
+    # save TSData (without metadata)
+    if (save):
+        SaveTSDs(tsds, dest_dir, workers)
     return tsds
 
+# save TSData files at once (as <dest_dir><name>.tsd)
+# workers: save with process pool
+def SaveTSDs(tsl, dest_dir='', workers=None):
+    args = [(tsd, dest_dir+tsd.metadata['name']+'.tsd') for tsd in tsl]
+    if (workers is None or workers <= 1):
+        for arg in args:
+            _save_worker(arg)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(_save_worker, args)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+    for tsd, path in args:
+        tsd.cur_path = path
+
+# (internal function)
+# process pool worker of SaveTSDs()
+def _save_worker(args):
+    tsd, path = args
+    tsd.save(path)
+
 # read tsd file's gene matrix (at once)
-def FillGenematrix(tsl, sep=','):
+# staged pipeline:
+# 1. parse: raw matrix files are parsed (in parallel) and aligned into single matrix
+# 2. share: aligned matrix is written as binary matrix file (memory-mapped by workers)
+# 3. save: each TSData takes its columns and is saved (in parallel)
+# workers: number of processes of parse / save stage
+# cache: TSData.GeneMatrixCache of parsed matrix files (None: not used)
+# binary: save matrix into binary sidecar file (None: as TSData option)
+# returns: elapsed time of each stage (dict, seconds)
+def FillGenematrix(tsl, sep=',', workers=None, cache=None, binary=None):
+    timings = {}
+    t = time.time()
     df_g = TSData.GeneMatrix()
     df_g.set_refine_columns()
     df_g.set_refine_index()
+    fps = []
     for tsd in tsl:
         for fp in tsd.df_meta.loc['Filepath']:
             if (fp == None or pd.isnull(fp)):
                 continue
-            df_g.load_from_path(fp, sep)
-    df_g = df_g.drop_duplicated_index()      # drop duplicated genename
-    for tsd in tsl:
-        print 'saving %s' % tsd.metadata['name']
-        tsd.readmatrix_from_matrix(df_g)
-        tsd.save()
+            fps.append(fp)
+    # (duplicated genename is dropped while loading)
+    df_g = df_g.load_from_paths(fps, sep, workers=workers, cache=cache)
+    timings['parse'] = time.time() - t
+    print 'parsed %d files (%.1fs)' % (len(df_g._files_read), timings['parse'])
+
+    # (matrix which cannot be shared as binary file is saved serially)
+    if (workers is None or workers <= 1 or not TSData.IsBinaryMatrix(df_g)):
+        t = time.time()
+        for i, tsd in enumerate(tsl):
+            tsd.readmatrix_from_matrix(df_g)
+            tsd.save(binary=binary)
+            print '[%d/%d] saved %s' % (i+1, len(tsl), tsd.metadata['name'])
+        timings['save'] = time.time() - t
+    else:
+        # matrix is shared in memory(tmpfs) if available
+        with TSData.WorkerPool(workers, 'FillGenematrix') as (pool, shm_dir):
+            t = time.time()
+            bin_path = os.path.join(shm_dir, 'genematrix.bin')
+            TSData.save_matrix_binary(bin_path, df_g)
+            timings['share'] = time.time() - t
+            t = time.time()
+            args = [(tsd, bin_path, binary) for tsd in tsl]
+            for i, name in enumerate(pool.imap_unordered(_fill_save_worker, args)):
+                print '[%d/%d] saved %s' % (i+1, len(tsl), name)
+        timings['save'] = time.time() - t
+        for tsd in tsl:
+            tsd.readmatrix_from_matrix(df_g)
+            if (binary is not None):
+                tsd.binary = binary
+    print 'FillGenematrix: %s' % ', '.join(['%s %.1fs' % (k, timings[k])
+        for k in ['parse', 'share', 'save'] if k in timings])
+    return timings
+
+# (internal function)
+# process pool worker of FillGenematrix()
+# takes columns from memory-mapped matrix, and saves TSData.
+def _fill_save_worker(args):
+    tsd, bin_path, binary = args
+    tsd.readmatrix_from_matrix(TSData.load_matrix_binary(bin_path, mmap=True))
+    tsd.save(binary=binary)
+    return tsd.metadata['name']
 
 #
 # loads Timeseries folder and manages them
@@ -90,20 +172,54 @@ class TSLoader(list):
         self.filters = {}
         # filter mode: 'drop' / 'modify'
         self.filter_mode = 'drop'
-    def loadpath(self, path='data'):
+    # dtype: dtype of matrix values (ex: np.float32)
+    # catalog: check filter with header catalog of path (see TSCatalog),
+    #   so only matching files are loaded.
+    # workers: parse files with process pool (filter is checked in workers).
+    #   matrices are returned through binary files in memory(tmpfs), not pickled.
+    def loadpath(self, path='data', dtype=None, catalog=False, workers=None):
+        if (catalog):
+            return self._loadpath_catalog(path, dtype, workers)
         # read Timeseries files from given path(directory)
-        fps = [f[:-4] for f in os.listdir(path) if f[-4:] == '.tsd']
-        for fp in fps:
-            tsd = TSData.load(os.path.join(path, fp+'.tsd'))
-            # check out filter
-            logics = self._filter_check_logic(tsd)
-            if (not logics.all()):
-                if (self.filter_mode == 'modify'):
-                    tsd.filter_by_logic(logics)
-                elif (self.filter_mode == 'drop'):
-                    print 'dropped: %s (%s)' % (fp, tsd.df_meta.loc['Species'].tolist()[0])
+        # (.tsd, or compressed .tsd.gz / .tsd.xz)
+        fps = sorted([f for f in os.listdir(path) if TSData.IsTSDataPath(f)])
+        self._loadfiles(path, fps, dtype, workers)
+    def _loadfiles(self, path, fps, dtype, workers):
+        if (workers is None or workers <= 1):
+            for fp in fps:
+                tsd = _load_filtered(os.path.join(path, fp), self.filters, self.filter_mode, dtype)
+                if (tsd is not None):
+                    self.append(tsd)
+            return
+        # matrices are written in memory(tmpfs) if available
+        with TSData.WorkerPool(workers, 'TSLoader') as (pool, shm_dir):
+            args = [(os.path.join(path, fp), self.filters, self.filter_mode, dtype, shm_dir) for fp in fps]
+            # (imap returns results in order)
+            for r in pool.imap(_loadpath_worker, args):
+                if (r is None):
                     continue
-            self.append(tsd)
+                tsd, shm_path = r
+                if (shm_path is not None):
+                    # read (writable, same as serial loading), then file can be removed
+                    tsd.df = TSData.load_matrix_binary(shm_path)
+                    os.remove(shm_path)
+                elif (not tsd.IsMatrixLoaded()):
+                    tsd.df = tsd.df.copy()  # (mapped from binary sidecar)
+                self.append(tsd)
+    def _loadpath_catalog(self, path, dtype, workers=None):
+        cat = TSCatalog(path)
+        cat.update()
+        df_s = cat.samples
+        logics = pd.Series(self._filter_check_table(df_s, ['File','SeriesID','Time'],
+            df_s['File'].map(lambda x: cat.files[x]['has_matrix']).values), index=df_s.index)
+        fps = []
+        for fp, logic in logics.groupby(df_s['File'], sort=True):
+            if (not logic.all() and self.filter_mode == 'drop'):
+                print 'dropped: %s (%s)' % (fp, df_s.loc[df_s['File'] == fp, 'Species'].tolist()[0])
+                continue
+            fps.append(fp)
+        # ('modify' filter is applied while loading)
+        self._loadfiles(path, fps, dtype, workers)
     def addfilter(self,k,v):
         self.filters[k]=v
     def clearfilter(self):
@@ -114,12 +230,10 @@ class TSLoader(list):
             self = [x.filter_by_logic(self._filter_check_logic(x)) for x in self]
         elif (self.filter_mode == 'drop'):
             self = filter(lambda t: self._filter_check_logic(t).all(), self)
-    def merge(self):
+    def merge(self, how='outer', dtype=None):
         # return a big merged single TSData
-        tsd = TSData.TSData()
-        for t in self:
-            tsd.append(t)
-        return tsd
+        # how: 'outer' / 'inner' / 'exact' (gene index, see TSData.merge())
+        return TSData.merge(self, how, dtype)
     # column: timeseries, row: [labelname]
     # if mixed, returns 'mixed'
     def get_labels(self, labelname='Stress'):
@@ -142,6 +256,17 @@ class TSLoader(list):
     # (internal function)
     # check is TSData suitable to filter
     def _filter_check_logic(self,tsd):
+        groups = None
+        if ('MinRepCnt' in self.filters):
+            groups = tsd.getSeriesGroups()
+        return self._filter_check_table(tsd.df_meta.transpose(), ['SeriesID','Time'],
+                tsd.HasMatrix(), groups)
+    # (internal function)
+    # check filter for sample table (row: sample, column: df_meta row)
+    # group_keys: columns which groups replication
+    # has_matrix: expression data exists (bool, or array for each sample)
+    # groups: TSSeriesGroups of samples, if already built (TSData.getSeriesGroups())
+    def _filter_check_table(self, df_t, group_keys, has_matrix, groups=None):
         # only filter for metadata
         filter_metadata = dict(self.filters)
         if ('MinRepCnt' in filter_metadata):
@@ -149,22 +274,150 @@ class TSLoader(list):
         if ('ExpExist' in filter_metadata):
             del filter_metadata['ExpExist']
         # first check metadata valid
-        logics = []
+        logic = np.ones(len(df_t.index), dtype=bool)
         for k,v in filter_metadata.items():
-            logics.append(tsd.df_meta.loc[k].str.match(v, case=False))
-        logic = np.logical_and.reduce( logics )
+            # (column with all empty value is float)
+            logic &= df_t[k].astype(object).str.match(v, case=False).fillna(False).values.astype(bool)
         # then check replication test
         if ('MinRepCnt' in self.filters):
-            # COMMENT: must match name with getSeries() dataframe column
             minrepcnt = int(self.filters['MinRepCnt'])
-            df_rep = tsd.getSeries().loc['count']
-            logic_minrep_group = (df_rep >= minrepcnt)
-            logic_minrep = [ logic_minrep_group[x[0]+'_'+x[1]] for x in zip(tsd.df_meta.loc['SeriesID'].tolist(),tsd.df_meta.loc['Time'].tolist()) ]
-            logic = np.logical_and(logic, logic_minrep)
+            if (groups is not None):
+                codes, rep_cnt = groups.codes, groups.counts
+            else:
+                # (leading keys are combined into one, ex: File + SeriesID)
+                series_codes = df_t[group_keys[0]].values
+                for k in group_keys[1:-1]:
+                    series_codes, _ = TSData.GroupSeries(series_codes, df_t[k].values, sort=False)
+                    series_codes = pd.Series(series_codes).where(series_codes >= 0).values
+                codes, keys = TSData.GroupSeries(series_codes,
+                        df_t[group_keys[-1]].values, sort=False)
+                rep_cnt = np.bincount(codes[codes >= 0], minlength=len(keys))
+            logic &= np.append(rep_cnt, 0)[codes] >= minrepcnt
         if ('ExpExist' in self.filters):
-            logic = logic & tsd.df.empty
+            logic &= has_matrix
         return logic
 
+#
+# lazy TSLoader
+# TSData is loaded with metadata only, and matrix is read at access.
+# at most (maxcount / maxbytes) matrices are resident at once (LRU).
+# (matrix of compressed file is decompressed again when it's read after dropped)
+# (workers option of loadpath() is ignored, as only headers are read)
+#
+class TSLazyLoader(TSLoader):
+    def __init__(self, maxcount=None, maxbytes=None):
+        super(TSLazyLoader, self).__init__()
+        self.cache = TSData.TSMatrixCache(maxcount, maxbytes)
+    def _loadfiles(self, path, fps, dtype, workers):
+        for fp in fps:
+            tsd = _load_filtered(os.path.join(path, fp), self.filters, self.filter_mode, dtype, lazy=True)
+            if (tsd is not None):
+                tsd.SetMatrixCache(self.cache)
+                self.append(tsd)
+
+# (internal function)
+# load TSData file and check out filter
+# returns: TSData, or None if dropped
+def _load_filtered(fpath, filters, filter_mode, dtype, lazy=False):
+    tsl = TSLoader()
+    tsl.filters = filters
+    tsl.filter_mode = filter_mode
+    tsd = TSData.load(fpath, lazy=lazy, dtype=dtype)
+    logics = tsl._filter_check_logic(tsd)
+    if (not logics.all()):
+        if (filter_mode == 'modify'):
+            tsd.filter_by_logic(logics)
+        elif (filter_mode == 'drop'):
+            print 'dropped: %s (%s)' % (os.path.basename(fpath), tsd.df_meta.loc['Species'].tolist()[0])
+            return None
+    return tsd
+
+# (internal function)
+# process pool worker of TSLoader.loadpath()
+# matrix is passed through memory-mapped file in shm_dir.
+# (binary sidecar is mapped directly, without writing)
+def _loadpath_worker(args):
+    fpath, filters, filter_mode, dtype, shm_dir = args
+    tsd = _load_filtered(fpath, filters, filter_mode, dtype, lazy=True)
+    if (tsd is None):
+        return None
+    fd, shm_path = tempfile.mkstemp(suffix='.bin', dir=shm_dir)
+    os.close(fd)
+    if (not tsd.MapMatrix(shm_path)):
+        os.remove(shm_path)
+        shm_path = None
+    return (tsd, shm_path)
+
+
+#
+# header catalog of Timeseries folder
+# (JSON metadata / df_meta of each file, keyed with filename, size and mtime)
+# saved as '.tscatalog' in the folder, and rebuilt incrementally when files change.
+# file format
+# - first line: JSON (filename: size, mtime, has_matrix, metadata)
+# - second line ~ end: sample table (row: sample, column: File, SampleID, df_meta rows)
+#
+class TSCatalog(object):
+    def __init__(self, path='data'):
+        self.path = path
+        self.catalog_path = os.path.join(path, '.tscatalog')
+        self.files = {}
+        self.samples = pd.DataFrame(columns=['File','SampleID'])
+
+    def load(self):
+        if (not os.path.exists(self.catalog_path)):
+            return False
+        with open(self.catalog_path, 'rb') as f:
+            self.files = json.loads(f.readline())
+            # (read as string, same as metadata of TSData)
+            self.samples = pd.read_csv(f, encoding='utf-8', dtype=object)
+        return True
+
+    def save(self):
+        path_tmp = '%s.tmp%d' % (self.catalog_path, os.getpid())
+        with open(path_tmp, 'wb') as f:
+            f.write(json.dumps(self.files) + '\n')
+            f.write(self.samples.to_csv(index=False, encoding='utf-8'))
+        os.rename(path_tmp, self.catalog_path)
+
+    # @description read headers of new / changed files only
+    # returns: True if catalog is changed
+    def update(self):
+        self.load()
+        stats = {}
+        for fp in os.listdir(self.path):
+            if (TSData.IsTSDataPath(fp)):
+                st = os.stat(os.path.join(self.path, fp))
+                stats[fp] = (st.st_size, st.st_mtime)
+        fps_removed = [fp for fp in self.files if fp not in stats]
+        fps_changed = [fp for fp, st in stats.items() if fp not in self.files
+                or (self.files[fp]['size'], self.files[fp]['mtime']) != st]
+        if (len(fps_removed) + len(fps_changed) == 0):
+            return False
+        # drop old entries, and read headers
+        fps_drop = set(fps_removed + fps_changed)
+        for fp in fps_drop:
+            self.files.pop(fp, None)
+        dfs = [self.samples[~self.samples['File'].isin(fps_drop)]]
+        for fp in sorted(fps_changed):
+            tsd = TSData.load(os.path.join(self.path, fp), lazy=True)
+            self.files[fp] = {
+                'size': stats[fp][0],
+                'mtime': stats[fp][1],
+                'has_matrix': tsd.HasMatrix(),
+                'metadata': tsd.metadata,
+                }
+            df_t = tsd.df_meta.transpose()
+            df_t.insert(0, 'SampleID', df_t.index)
+            df_t.insert(0, 'File', fp)
+            dfs.append(df_t)
+        cols = []
+        for df in dfs:
+            cols += [c for c in df.columns if c not in cols]
+        self.samples = pd.concat([df.reindex(columns=cols) for df in dfs], ignore_index=True)
+        self.save()
+        return True
+
 
 
 
@@ -172,74 +425,49 @@ class TSLoader(list):
 # DEG(gene expression) processing part
 #
 
-def _do_DEG_per_timepoint(tsd, strict_rep):
+# compare each timepoint with first timepoint, using t-test of replications
+# (replication statistics are computed at once with TSData.getSeriesStats())
+# returns: {'pvalue': DataFrame, 'tvalue': DataFrame}
+#   (index: genes, columns: 'SeriesID_Time' of each timepoint except first)
+def _do_DEG_per_timepoint(tsd, strict_rep=False):
+    import scipy.stats
     default_rep_std = 0.2
     default_rep_cnt = 2
-    strict_rep = False
 
-    reps = tsd.getReplication()
+    st = tsd.getSeriesStats(ddof=0)
     use_bonf_adj=False
     if (use_bonf_adj):
-        thres = thres/len(reps)
+        thres = thres/len(st['keys'])
     # check for exception (single timepoint not allowed)
-    if (len(reps) == 1):
+    if (len(st['keys']) == 1):
         raise Exception('single timepoint is not allowed!')
     # gather tp/std/mean for each tp
-    rep_means = []
-    rep_stds = []
-    rep_cnts = []
-    rep_x = []
-    for rep in reps:
-        rep_tp = float(rep['x'])
-        samples = tsd.df[rep['samples']]
-        rep_cnt = samples.shape[1]
-        rep_mean = np.mean(samples,axis=1)
-        if (rep_cnt == 1):
-            if (strict_rep):
-                raise Exception('Replication must be over 2; single replication not allowed.')
-            rep_std = np.full(rep_mean.shape, default_rep_std)
-            rep_cnt = default_rep_cnt
-        else:
-            rep_std = np.std(samples,axis=1)
-        rep_means.append(rep_mean)
-        rep_stds.append(rep_std)
-        rep_cnts.append(rep_cnt)
-        rep_x.append(rep_tp)
-    # calculate Ttest p-value for each timepoint
-    _shape = rep_means[0].shape
-    ts_pval = [] #[np.full(_shape,0),]  # default pvalue(non_deg)
-    ts_tval = []                        # t value
-    ts_tp = rep_x[1:] #[-1.0,]+rep_x[1:]          # default timepoint(zero)
-    mean0 = rep_means[0]
-    std0 = rep_stds[0]
-    cnt0 = rep_cnts[0]
-    for (mean,std,cnt) in zip(rep_means[1:],rep_stds[1:],rep_cnts[1:]):
-        val_t, val_p = scipy.stats.ttest_ind_from_stats(
-                mean0,std0,cnt0,
-                mean,std,cnt)
-        """
-        if (thres > 0):
-            val_p[val_p < thres] = 0
-            val_p[val_p >= thres] = 1
-        val_p = 1-val_p
-        val_sign = (val_t>0)*2-1     # get sign - down DEG or up DEG?
-        val_sign *= -1
-        arr_p = val_p*val_sign
-        """
-        ts_pval.append(ts_pval)
-        ts_tval.append(ts_tval)
-    # regenerate as dataframe (colname: tsd.metadata['name'], rowname: tsd.get_index())
-    df_pval = pd.DataFrame(np.array(ts_pval), index=tsd.get_index(), columns=[tsd.metadata['name'],])
-    df_tval = pd.DataFrame(np.array(ts_tval), index=tsd.get_index(), columns=[tsd.metadata['name'],])
+    rep_means = st['mean'].values
+    rep_stds = st['std'].values
+    rep_cnts = st['count'].astype(float)
+    single = rep_cnts == 1
+    if (single.any()):
+        if (strict_rep):
+            raise Exception('Replication must be over 2; single replication not allowed.')
+        rep_stds[:, single] = default_rep_std
+        rep_cnts[single] = default_rep_cnt
+    # calculate Ttest p-value for each timepoint (against first timepoint)
+    val_t, val_p = scipy.stats.ttest_ind_from_stats(
+            rep_means[:, :1], rep_stds[:, :1], rep_cnts[0],
+            rep_means[:, 1:], rep_stds[:, 1:], rep_cnts[1:])
+    # regenerate as dataframe (rowname: tsd.get_index())
+    cols = st['labels'][1:]
+    df_pval = pd.DataFrame(val_p, index=st['mean'].index, columns=cols)
+    df_tval = pd.DataFrame(val_t, index=st['mean'].index, columns=cols)
     return {'pvalue': df_pval, 'tvalue': df_tval}
 def do_DEG_per_timepoint(tsl, strict_rep=False):
-    if (type(tsl) is TSData):
-        return _do_DEG_per_timepoint(tsl)
+    if (type(tsl) is TSData.TSData):
+        return _do_DEG_per_timepoint(tsl, strict_rep)
     else:
         r_pv = []
         r_tv = []
         for tsd in tsl:
-            d = _do_DEG_per_timepoint(tsd)
+            d = _do_DEG_per_timepoint(tsd, strict_rep)
             r_pv.append( d['pvalue'] )
             r_tv.append( d['tvalue'] )
         r_pv = pd.concat(r_pv, axis=1) # TODO: is this correct?